@@ -0,0 +1,49 @@
+"""
+Analyzes closed tickets without an analisequalidade row (replaces the nightly n8n job).
+
+    python backlog_analyzer.py                 # resume from the checkpoint
+    python backlog_analyzer.py --limit 500     # stop after 500 tickets
+    python backlog_analyzer.py --from-start    # ignore the checkpoint (retries earlier failures)
+"""
+import argparse
+import asyncio
+import logging
+
+# Force load Env if needed (before core.database reads DATABASE_URL)
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.database import engine
+from services.backlog import BacklogAnalyzer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyze closed tickets that have no quality analysis yet.")
+    parser.add_argument("--limit", type=int, default=None, help="max tickets to analyze in this run")
+    parser.add_argument("--concurrency", type=int, default=None, help="parallel LLM calls (BACKLOG_CONCURRENCY)")
+    parser.add_argument("--page-size", type=int, default=None, help="tickets per keyset page (BACKLOG_PAGE_SIZE)")
+    parser.add_argument("--write-batch", type=int, default=None, help="analyses per insert (BACKLOG_WRITE_BATCH)")
+    parser.add_argument("--provider", default=None, help="openai, anthropic or gemini (BACKLOG_PROVIDER)")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file (BACKLOG_CHECKPOINT_PATH)")
+    parser.add_argument("--from-start", action="store_true", help="ignore the saved checkpoint")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    analyzer = BacklogAnalyzer(
+        concurrency=args.concurrency,
+        page_size=args.page_size,
+        write_batch=args.write_batch,
+        provider=args.provider,
+        checkpoint_path=args.checkpoint,
+    )
+    try:
+        await analyzer.run(limit=args.limit, resume=not args.from_start)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(main())
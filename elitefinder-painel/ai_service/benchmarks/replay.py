@@ -0,0 +1,309 @@
+"""
+Replays the exported `dados db` CSVs against an in-process ai_service with stub LLM providers.
+
+Phases:
+  webhooks  every mensagem row as a WAHA webhook on /webhooks/waha, then waits for the queue to drain
+  analyze   POST /analyze with conversations rebuilt from the CSV
+  batch     POST /analyze/batch with every conversation per request (NDJSON, one line each)
+  report    POST /report?from_rollups=true
+
+Reports requests/sec, p50/p95/p99 latency, SQL statements per message and RSS memory.
+Runs entirely on localhost (SQLite by default, or --database-url for a scratch Postgres).
+
+    python -m benchmarks.replay --tickets 200 --concurrency 32 --latency-ms 300
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+AI_SERVICE = Path(__file__).resolve().parent.parent
+DEFAULT_DATA_DIR = AI_SERVICE.parent.parent / "dados db"
+sys.path.insert(0, str(AI_SERVICE))
+
+from benchmarks.stub_llm import StubServer, add_arguments, config_from_args, install_gemini_stub
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        return 0.0
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on Linux
+
+
+class StatementCounter:
+    """Counts SQL statements sent to the database (one per cursor execute)."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def load_conversations(data_dir: Path, max_tickets: int):
+    """Returns {id_atendimento: {"phone", "name", "messages": [(sender, text), ...]}} in send order."""
+    tickets = {}
+    with open(data_dir / "atendimento.csv", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            ticket_id = int(row["id_atendimento"])
+            phone = row["telefone_cliente"] if row["telefone_cliente"] not in ("", "NULL") else f"55519{ticket_id:08d}"
+            tickets[ticket_id] = {"phone": phone, "name": row["nome_cliente"], "messages": []}
+
+    rows = []
+    with open(data_dir / "mensagem.csv", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            ticket_id = int(row["id_atendimento"])
+            if ticket_id in tickets and row["conteudo_texto"] not in ("", "NULL"):
+                rows.append((row["data_hora_envio"], int(row["id_mensagem"]), ticket_id, row["remetente_tipo"].lower(), row["conteudo_texto"]))
+    for _, _, ticket_id, sender, text in sorted(rows):
+        tickets[ticket_id]["messages"].append((sender, text))
+
+    selected = [ticket_id for ticket_id, ticket in sorted(tickets.items()) if ticket["messages"]][:max_tickets]
+    return {ticket_id: tickets[ticket_id] for ticket_id in selected}
+
+
+def waha_events(conversations):
+    """Interleaves tickets in CSV order as WAHA webhook payloads."""
+    events = []
+    for ticket_id, ticket in conversations.items():
+        for index, (sender, text) in enumerate(ticket["messages"]):
+            events.append((index, ticket_id, {
+                "event": "message" if sender == "cliente" else "message.any",
+                "session": "default",
+                "payload": {
+                    "id": f"bench_{ticket_id}_{index}",
+                    "from": f"{ticket['phone']}@c.us",
+                    "to": "5551000000000@c.us",
+                    "body": text,
+                    "hasMedia": False,
+                    "type": "chat",
+                    "timestamp": int(time.time()),
+                },
+            }))
+    events.sort(key=lambda item: (item[0], item[1])) # round-robin across conversations
+    return [payload for _, _, payload in events]
+
+
+async def run_requests(client, requests, concurrency: int):
+    """Sends (method, url, json) requests with bounded concurrency; returns (latencies_ms, errors, seconds)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], defaultdict(int)
+
+    async def one(method, url, body):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, json=body)
+                if response.status_code >= 400:
+                    errors[response.status_code] += 1
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(*request) for request in requests))
+    return latencies, dict(errors), time.perf_counter() - started
+
+
+async def run_batches(client, bodies, count: int, concurrency: int):
+    """POSTs /analyze/batch `count` times; a response missing result lines counts as an error."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], defaultdict(int)
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post("/analyze/batch", json={"conversations": bodies})
+                if response.status_code >= 400:
+                    errors[response.status_code] += 1
+                elif len(response.text.splitlines()) != len(bodies):
+                    errors["missing_results"] += 1
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    return latencies, dict(errors), time.perf_counter() - started
+
+
+def summarize(name, latencies, errors, seconds, **extra):
+    result = {
+        "phase": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rps": round(len(latencies) / seconds, 1) if seconds else 0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "rss_mb": round(rss_mb(), 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    result.update(extra)
+    return result
+
+
+async def wait_for_drain(total_messages: int, timeout: float):
+    """Waits until every webhook job is processed and every message is committed."""
+    from sqlalchemy import select, func
+    from core.database import SessionLocal
+    from models.db_models import Mensagem, WebhookJob
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        async with SessionLocal() as db:
+            jobs = (await db.execute(select(func.count()).select_from(WebhookJob).where(WebhookJob.status != "dead"))).scalar_one()
+            saved = (await db.execute(select(func.count()).select_from(Mensagem))).scalar_one()
+        if jobs == 0 and saved >= total_messages:
+            return saved
+        await asyncio.sleep(0.05)
+    return saved
+
+
+async def benchmark(args):
+    import httpx
+    from main import app
+    from core.database import engine
+
+    install_gemini_stub(args.stub_url)
+    counter = StatementCounter(engine)
+    headers = {"X-Internal-API-Key": os.environ["INTERNAL_API_KEY"]}
+    conversations = load_conversations(Path(args.data_dir), args.tickets)
+    results = []
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://ai-service", headers=headers, timeout=120) as client:
+            if "webhooks" in args.phases:
+                payloads = waha_events(conversations)
+                statements_before, started = counter.count, time.perf_counter()
+                latencies, errors, seconds = await run_requests(client, [("POST", "/webhooks/waha", p) for p in payloads], args.concurrency)
+                saved = await wait_for_drain(len(payloads), args.drain_timeout)
+                # Latency is the webhook ack; throughput is end to end (acked, processed and committed)
+                ingest_seconds = time.perf_counter() - started
+                results.append(summarize(
+                    "webhooks", latencies, errors, seconds,
+                    messages_saved=saved,
+                    ingest_seconds=round(ingest_seconds, 3),
+                    messages_per_sec=round(saved / ingest_seconds, 1),
+                    sql_per_message=round((counter.count - statements_before) / max(saved, 1), 2),
+                ))
+
+            bodies = [
+                {
+                    "conversation_id": str(ticket_id),
+                    "messages": [{"role": sender, "content": text} for sender, text in ticket["messages"]],
+                    "provider": args.provider,
+                }
+                for ticket_id, ticket in conversations.items()
+            ]
+            if "analyze" in args.phases:
+                requests = [("POST", "/analyze", bodies[i % len(bodies)]) for i in range(args.analyze_requests)]
+                statements_before = counter.count
+                latencies, errors, seconds = await run_requests(client, requests, args.concurrency)
+                results.append(summarize("analyze", latencies, errors, seconds, sql_statements=counter.count - statements_before))
+
+            if "batch" in args.phases:
+                statements_before = counter.count
+                latencies, errors, seconds = await run_batches(client, bodies, args.batch_requests, args.concurrency)
+                results.append(summarize("batch", latencies, errors, seconds, conversations_per_request=len(bodies), sql_statements=counter.count - statements_before))
+
+            if "report" in args.phases:
+                body = {"tenant_id": 0, "period": "weekly"}
+                requests = [("POST", "/report?from_rollups=true", body)] * args.report_requests
+                statements_before = counter.count
+                latencies, errors, seconds = await run_requests(client, requests, args.concurrency)
+                results.append(summarize("report", latencies, errors, seconds, sql_statements=counter.count - statements_before))
+
+    return results
+
+
+def print_table(results):
+    columns = ["phase", "requests", "rps", "p50_ms", "p95_ms", "p99_ms", "rss_mb", "peak_rss_mb"]
+    print(" | ".join(f"{c:>11}" for c in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[c]):>11}" for c in columns))
+        extra = {k: v for k, v in result.items() if k not in columns}
+        print(f"{'':>11}   {extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmark for ai_service with stub LLM providers")
+    parser.add_argument("--data-dir", default=str(DEFAULT_DATA_DIR))
+    parser.add_argument("--tickets", type=int, default=100, help="conversations taken from atendimento.csv")
+    parser.add_argument("--phases", default="webhooks,analyze,batch,report")
+    parser.add_argument("--concurrency", type=int, default=32, help="in-flight client requests")
+    parser.add_argument("--analyze-requests", type=int, default=200)
+    parser.add_argument("--batch-requests", type=int, default=5, help="/analyze/batch calls, each with every conversation")
+    parser.add_argument("--report-requests", type=int, default=20)
+    parser.add_argument("--provider", default="openai", help="provider for /analyze")
+    parser.add_argument("--database-url", default=None, help="scratch database (default: temporary SQLite file)")
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    parser.add_argument("--llm-cache", action="store_true", help="keep the LLM response cache on (off by default)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    args.phases = set(args.phases.split(","))
+
+    stub = StubServer(config_from_args(args), port=args.stub_port).start()
+    args.stub_url = stub.url
+    scratch = None
+    if not args.database_url:
+        scratch = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        args.database_url = f"sqlite+aiosqlite:///{scratch.name}"
+
+    # Settings are read at import time, so configure before importing the app
+    os.environ.update({
+        "DATABASE_URL": args.database_url,
+        "INTERNAL_API_KEY": "benchmark",
+        "OPENAI_API_KEY": "stub",
+        "ANTHROPIC_API_KEY": "stub",
+        "GEMINI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"{stub.url}/v1",
+        "ANTHROPIC_BASE_URL": stub.url,
+        "LLM_CACHE_ENABLED": "true" if args.llm_cache else "false",
+        "AUTO_CREATE_SCHEMA": "true", # scratch database
+    })
+
+    try:
+        results = asyncio.run(benchmark(args))
+    finally:
+        stub.stop()
+        if scratch:
+            os.unlink(scratch.name)
+
+    print_table(results)
+    print(f"stub provider calls: {stub.config.requests}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "phases"}, "results": results}, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Local stand-in for the OpenAI, Anthropic and Gemini HTTP APIs.
+
+Every endpoint waits a configurable time-to-first-token, then returns (or streams)
+a fixed number of tokens with a per-token delay, so ai_service can be load tested
+with no network and no provider bill.
+
+    python -m benchmarks.stub_llm --port 9100 --latency-ms 400 --tokens 120 --token-delay-ms 5
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Valid for both the analysis and the report parsers
+ANALYSIS_JSON = {
+    "score": 82,
+    "sentiment": "Positivo",
+    "summary": "Cliente pediu informações sobre o veículo e recebeu proposta.",
+    "strengths": ["Resposta cordial", "Uso do nome do cliente"],
+    "weaknesses": ["Demora na segunda resposta"],
+    "suggestion": "Enviar proposta por escrito.",
+    "risk_level": "Baixo",
+    "strategic_insight": "Volume estável com boa conversão.",
+    "action_items": ["Reduzir tempo de resposta"],
+    "forecast": "Tendência de alta.",
+}
+
+
+class StubConfig:
+    def __init__(self, latency_ms: float = 300, jitter_ms: float = 100, tokens: int = 80, token_delay_ms: float = 5):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens = tokens
+        self.token_delay_ms = token_delay_ms
+        self.requests = {"openai": 0, "anthropic": 0, "gemini": 0}
+
+    async def first_token(self):
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        await asyncio.sleep(max(delay, 0) / 1000)
+
+    def chunks(self, skip: int = 0):
+        """Splits the JSON answer (minus `skip` prefilled chars) into `tokens` pieces (at least one)."""
+        text = json.dumps(ANALYSIS_JSON, ensure_ascii=False)[skip:]
+        count = max(1, min(self.tokens, len(text)))
+        size = -(-len(text) // count)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def create_app(config: StubConfig) -> FastAPI:
+    app = FastAPI(title="Stub LLM providers")
+
+    async def sse(events):
+        for event in events:
+            await asyncio.sleep(config.token_delay_ms / 1000)
+            yield event
+
+    async def full_delay():
+        await config.first_token()
+        await asyncio.sleep(config.token_delay_ms * len(config.chunks()) / 1000)
+
+    @app.get("/stats")
+    async def stats():
+        return config.requests
+
+    # --- OpenAI: POST /v1/chat/completions ---
+    @app.post("/v1/chat/completions")
+    async def openai_chat(request: Request):
+        body = await request.json()
+        config.requests["openai"] += 1
+        model, created, completion_id = body.get("model"), int(time.time()), f"chatcmpl-{uuid.uuid4().hex}"
+        chunks = config.chunks()
+        if body.get("stream"):
+            await config.first_token()
+            events = [
+                "data: " + json.dumps({
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}],
+                }) + "\n\n"
+                for chunk in chunks
+            ]
+            events.append("data: " + json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }) + "\n\n")
+            events.append("data: [DONE]\n\n")
+            return StreamingResponse(sse(events), media_type="text/event-stream")
+        await full_delay()
+        return JSONResponse({
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(chunks)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": len(chunks), "total_tokens": 100 + len(chunks)},
+        })
+
+    # --- Anthropic: POST /v1/messages ---
+    @app.post("/v1/messages")
+    async def anthropic_messages(request: Request):
+        body = await request.json()
+        config.requests["anthropic"] += 1
+        message_id, model = f"msg_{uuid.uuid4().hex}", body.get("model")
+        # A trailing assistant turn is a prefill: the answer continues after it
+        last = body["messages"][-1]
+        chunks = config.chunks(len(last["content"]) if last["role"] == "assistant" else 0)
+        usage = {"input_tokens": 100, "output_tokens": len(chunks)}
+        if body.get("stream"):
+            await config.first_token()
+
+            def event(name, data):
+                return f"event: {name}\ndata: {json.dumps({'type': name, **data})}\n\n"
+
+            events = [
+                event("message_start", {"message": {
+                    "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+                    "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 100, "output_tokens": 0},
+                }}),
+                event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}),
+                *[event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": chunk}}) for chunk in chunks],
+                event("content_block_stop", {"index": 0}),
+                event("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": len(chunks)}}),
+                event("message_stop", {}),
+            ]
+            return StreamingResponse(sse(events), media_type="text/event-stream")
+        await full_delay()
+        return JSONResponse({
+            "id": message_id, "type": "message", "role": "assistant", "model": model,
+            "content": [{"type": "text", "text": "".join(chunks)}],
+            "stop_reason": "end_turn", "stop_sequence": None, "usage": usage,
+        })
+
+    # --- Gemini (REST transport): POST /v1beta/models/{model}:generateContent | :streamGenerateContent ---
+    @app.post("/v1beta/models/{model_action:path}")
+    async def gemini_generate(model_action: str, request: Request):
+        config.requests["gemini"] += 1
+        chunks = config.chunks()
+
+        def candidate(text, finish=None):
+            payload = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}]}
+            if finish:
+                payload["candidates"][0]["finishReason"] = finish
+                payload["usageMetadata"] = {"promptTokenCount": 100, "candidatesTokenCount": len(chunks), "totalTokenCount": 100 + len(chunks)}
+            return payload
+
+        if model_action.endswith(":streamGenerateContent"):
+            await config.first_token()
+            if request.query_params.get("alt") == "sse":
+                events = [f"data: {json.dumps(candidate(c, 'STOP' if i == len(chunks) - 1 else None))}\r\n\r\n" for i, c in enumerate(chunks)]
+                return StreamingResponse(sse(events), media_type="text/event-stream")
+            # Without alt=sse the REST API streams one JSON array
+            items = [json.dumps(candidate(c, 'STOP' if i == len(chunks) - 1 else None)) for i, c in enumerate(chunks)]
+            parts = ["[" + items[0]] + ["," + item for item in items[1:]] + ["]"]
+            return StreamingResponse(sse(parts), media_type="application/json")
+        await full_delay()
+        return JSONResponse(candidate("".join(chunks), "STOP"))
+
+    return app
+
+
+class StubServer:
+    """Runs the stub app with uvicorn in a background thread (for in-process benchmarks)."""
+
+    def __init__(self, config: StubConfig, host: str = "127.0.0.1", port: int = 9100):
+        import uvicorn
+        self.config = config
+        self.url = f"http://{host}:{port}"
+        self._server = uvicorn.Server(uvicorn.Config(create_app(config), host=host, port=port, log_level="warning", access_log=False))
+        self._thread = threading.Thread(target=self._server.run, name="stub-llm", daemon=True)
+
+    def start(self, timeout: float = 10.0):
+        self._thread.start()
+        deadline = time.monotonic() + timeout
+        while not self._server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Stub LLM server did not start")
+            time.sleep(0.05)
+        return self
+
+    def stop(self):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=300, help="time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--tokens", type=int, default=80, help="chunks per completion")
+    parser.add_argument("--token-delay-ms", type=float, default=5)
+
+
+def config_from_args(args) -> StubConfig:
+    return StubConfig(args.latency_ms, args.jitter_ms, args.tokens, args.token_delay_ms)
+
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _StubGeminiStream:
+    def __init__(self, response):
+        self._response = response
+
+    async def __aiter__(self):
+        async for line in self._response.aiter_lines():
+            if line.startswith("data: "):
+                data = json.loads(line[6:])
+                yield _Chunk(data["candidates"][0]["content"]["parts"][0]["text"])
+
+
+class StubGeminiModel:
+    """
+    Drop-in for genai.GenerativeModel that talks to the stub's Gemini REST endpoint.
+    google-generativeai only offers async calls over gRPC (TLS), so Gemini is stubbed
+    at the SDK boundary while OpenAI/Anthropic go through their real SDKs.
+    """
+
+    def __init__(self, base_url: str, model_name: str):
+        import httpx
+        self._client = httpx.AsyncClient(base_url=base_url, timeout=60)
+        self._model_name = model_name
+
+    async def generate_content_async(self, contents, stream: bool = False):
+        body = {"contents": [{"parts": [{"text": str(contents)[:1000]}]}]}
+        if not stream:
+            response = await self._client.post(f"/v1beta/models/{self._model_name}:generateContent", json=body)
+            response.raise_for_status()
+            return _Chunk(response.json()["candidates"][0]["content"]["parts"][0]["text"])
+        request = self._client.build_request("POST", f"/v1beta/models/{self._model_name}:streamGenerateContent", params={"alt": "sse"}, json=body)
+        response = await self._client.send(request, stream=True)
+        return _StubGeminiStream(response)
+
+
+def install_gemini_stub(base_url: str):
+    """Routes every services.llm Gemini call to the stub server."""
+    from services import llm
+    models = {}
+
+    def stub_model(model_name: str, generation_params: tuple = ()):
+        if model_name not in models:
+            models[model_name] = StubGeminiModel(base_url, model_name)
+        return models[model_name]
+
+    llm._gemini_model = stub_model
+
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Stub OpenAI/Anthropic/Gemini server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
@@ -1,4 +1,5 @@
 import os
+from typing import Dict, List
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -12,9 +13,133 @@ class Settings(BaseSettings):
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     ANTHROPIC_API_KEY: str = os.getenv("ANTHROPIC_API_KEY", "")
+    # Optional API endpoint overrides (proxies, benchmarks/stub_llm.py)
+    OPENAI_BASE_URL: str = ""
+    ANTHROPIC_BASE_URL: str = ""
     
     # Database
     DATABASE_URL: str = os.getenv("DATABASE_URL", "")
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800 # seconds, stay below PgBouncer/server idle timeouts
+    DB_ECHO: bool = False
+    # Schema is a deploy step (`python init_tables.py`); true runs it on every worker start (local dev)
+    AUTO_CREATE_SCHEMA: bool = False
+
+    # Webhook ingestion queue
+    WEBHOOK_QUEUE_WORKERS: int = 4
+    WEBHOOK_QUEUE_MAX_DEPTH: int = 5000 # pending jobs before WAHA gets a 503
+    WEBHOOK_QUEUE_MAX_ATTEMPTS: int = 5
+    WEBHOOK_QUEUE_RETRY_BASE_SECONDS: float = 2.0
+    WEBHOOK_QUEUE_RETRY_MAX_SECONDS: float = 300.0
+    WEBHOOK_QUEUE_POLL_INTERVAL: float = 1.0
+    WEBHOOK_QUEUE_VISIBILITY_TIMEOUT: int = 300 # seconds before a stuck job is re-queued
+    WEBHOOK_DEDUP_SIZE: int = 50000 # WAHA message ids remembered per process (see services/dedup.py)
+
+    # Message persistence (group commit)
+    MESSAGE_BATCH_WINDOW_MS: float = 5.0
+    MESSAGE_BATCH_MAX_SIZE: int = 200
+
+    # Phone -> open ticket cache
+    TICKET_CACHE_SIZE: int = 10000
+    TICKET_CACHE_TTL_SECONDS: float = 600.0 # bounds staleness for tickets closed by the painel/n8n
+
+    # agent_config cache (version check interval across workers)
+    AGENT_CONFIG_CACHE_TTL_SECONDS: float = 30.0
+
+    # Max concurrent in-flight calls per LLM provider (per worker process)
+    LLM_CONCURRENCY_OPENAI: int = 16
+    LLM_CONCURRENCY_ANTHROPIC: int = 8
+    LLM_CONCURRENCY_GEMINI: int = 8
+    # Requests per minute per provider (0 = unlimited)
+    LLM_RPM_OPENAI: int = 0
+    LLM_RPM_ANTHROPIC: int = 0
+    LLM_RPM_GEMINI: int = 0
+    # Estimated tokens (prompt + max_tokens) per minute per provider (0 = unlimited)
+    LLM_TPM_OPENAI: int = 0
+    LLM_TPM_ANTHROPIC: int = 0
+    LLM_TPM_GEMINI: int = 0
+    # Per-tenant caps across providers (0 = unlimited) and fair-share weights, e.g. {"3": 2.0}
+    TENANT_LLM_RPM: int = 0
+    TENANT_LLM_TPM: int = 0
+    TENANT_LLM_WEIGHTS: Dict[str, float] = {}
+
+    # Provider routing: failover order, circuit breaker and hedging for analysis calls
+    LLM_FALLBACK_ORDER: str = "openai,anthropic,gemini"
+    LLM_TIMEOUT_SECONDS: float = 90.0 # per attempt, then fail over
+    LLM_BREAKER_WINDOW: int = 20 # recent calls considered per provider
+    LLM_BREAKER_MIN_CALLS: int = 5
+    LLM_BREAKER_ERROR_RATE: float = 0.5
+    LLM_BREAKER_COOLDOWN_SECONDS: float = 30.0
+    LLM_HEDGE_ENABLED: bool = False
+    LLM_HEDGE_MIN_DELAY_MS: float = 2000.0 # never hedge sooner than this, even if p95 is lower
+
+    # Structured output: provider JSON mode (OpenAI response_format, Gemini response_mime_type,
+    # Anthropic "{" prefill) for calls that expect JSON; unparseable answers get one repair re-ask
+    LLM_JSON_MODE: bool = True
+    LLM_REPAIR_REASK: bool = True
+
+    # Cost estimate for /metrics: model -> [USD per 1M input tokens, USD per 1M output tokens]
+    LLM_PRICING: Dict[str, List[float]] = {}
+
+    # Shared HTTP clients
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0
+
+    # Media downloads
+    MEDIA_MAX_BYTES: int = 25 * 1024 * 1024
+    MEDIA_SPOOL_MEMORY_BYTES: int = 1024 * 1024 # larger files spill to a temp file
+    MEDIA_DOWNLOAD_TIMEOUT: float = 30.0
+
+    # Spreadsheet previews (process pool)
+    SPREADSHEET_WORKERS: int = 2
+    SPREADSHEET_TIMEOUT: float = 20.0
+    SPREADSHEET_MEMORY_LIMIT_MB: int = 512
+    SPREADSHEET_MAX_ROWS: int = 1000 # rows profiled per sheet
+    SPREADSHEET_MAX_SHEETS: int = 5
+    SPREADSHEET_SAMPLE_ROWS: int = 20 # rows pasted verbatim into the prompt
+
+    # Transcript budgeting (estimated tokens)
+    TRANSCRIPT_TOKEN_BUDGET: int = 6000 # above this, analysis switches to map-reduce
+    TRANSCRIPT_CHUNK_TOKENS: int = 4000
+    TRANSCRIPT_MAX_TURN_TOKENS: int = 1500
+    ANALYSIS_MAP_CONCURRENCY: int = 4
+
+    # Per-chat analysis trigger on incoming messages, debounced to one analysis per burst
+    ANALYSIS_ON_MESSAGE: bool = False
+    ANALYSIS_DEBOUNCE_SECONDS: float = 20.0 # idle time that closes a burst
+    ANALYSIS_DEBOUNCE_MAX_WAIT_SECONDS: float = 120.0 # analyze anyway when a chat never goes idle
+    ANALYSIS_TRIGGER_PROVIDER: str = "openai"
+
+    # Ticket analyses (analyze_ticket): incremental from ticket_analysis_state, full every N updates
+    ANALYSIS_INCREMENTAL: bool = True
+    ANALYSIS_FULL_EVERY: int = 10 # incremental updates before a full re-analysis resets drift
+
+    # POST /analyze/batch
+    ANALYZE_BATCH_CONCURRENCY: int = 8
+    ANALYZE_BATCH_MAX_ITEMS: int = 1000
+
+    # Backlog analyzer (python backlog_analyzer.py)
+    BACKLOG_CONCURRENCY: int = 8
+    BACKLOG_PAGE_SIZE: int = 200 # tickets per keyset page
+    BACKLOG_WRITE_BATCH: int = 50 # analyses per INSERT/commit
+    BACKLOG_PROVIDER: str = "openai"
+    BACKLOG_CHECKPOINT_PATH: str = ".backlog_checkpoint.json"
+
+    # Metric rollups (metric_rollup_daily) and /report?from_rollups=true
+    ROLLUP_TIMEZONE: str = "America/Sao_Paulo" # days are bucketed in this zone
+    ROLLUP_RESPONSE_LOOKBACK_HOURS: int = 24 # how far back a reply looks for the unanswered client message
+    REPORT_LOW_SCORE: float = 6.0 # average pontuacao_geral (0-10) flagged as an alert
+    REPORT_SLOW_RESPONSE_MINUTES: float = 30.0
+
+    # LLM response cache (memory LRU + llm_cache table)
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    LLM_CACHE_MEMORY_SIZE: int = 1000
+    LLM_CACHE_MAX_ROWS: int = 50000
+    LLM_CACHE_PRUNE_EVERY: int = 500 # writes between table prunes
 
     # Models Configuration
     # Analysis Models (OpenAI / Anthropic)
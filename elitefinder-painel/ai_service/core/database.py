@@ -1,29 +1,53 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
 from core.config import settings
 import os
 
 # Use DATABASE_URL from environment or fallback
 DATABASE_URL = settings.DATABASE_URL or os.getenv("DATABASE_URL")
 
-print(f"DEBUG: DATABASE_URL found? {'Yes' if DATABASE_URL else 'No'}")
-
 if not DATABASE_URL:
     print("❌ Critical Error: DATABASE_URL is missing from environment variables.")
     raise ValueError("DATABASE_URL is not set")
 
-# Handle 'postgres://' vs 'postgresql://' for SQLAlchemy
+# Handle 'postgres://' vs 'postgresql://' and force the asyncpg driver
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+if DATABASE_URL.startswith("postgresql://"):
+    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+engine_kwargs = {
+    "echo": settings.DB_ECHO,
+    "pool_pre_ping": True,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+}
+# SQLite (local dev) uses a static pool without size/overflow knobs
+if not DATABASE_URL.startswith("sqlite"):
+    engine_kwargs.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+    )
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(DATABASE_URL, **engine_kwargs)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+def _pool_gauges():
+    from core.metrics import registry
+    pool = engine.sync_engine.pool
+    gauge = registry.gauge("aiservice_db_pool_connections", "SQLAlchemy pool connections by state", ["state"])
+
+    def collect():
+        for state in ("size", "checkedout", "checkedin", "overflow"):
+            if hasattr(pool, state):
+                gauge.set(getattr(pool, state)(), state=state)
+
+    registry.add_collector(collect)
+
+_pool_gauges()
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,87 @@
+import logging
+from typing import Dict
+
+import httpx
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2 # noqa: F401 (installed via httpx[http2])
+        return True
+    except ImportError:
+        return False
+
+
+def pool_stats(client: httpx.AsyncClient) -> dict:
+    """Connection pool utilization, read from httpcore internals (best effort)."""
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []) or [])
+    idle = sum(1 for conn in connections if conn.is_idle())
+    return {
+        "connections": len(connections),
+        "idle": idle,
+        "active": len(connections) - idle,
+        "requests_waiting": sum(1 for request in getattr(pool, "_requests", []) if request.connection is None),
+        "max_connections": getattr(pool, "_max_connections", None),
+        "http2": bool(getattr(pool, "_http2", False)),
+    }
+
+
+class HTTPClientRegistry:
+    """
+    Application-lifetime httpx clients, one per target, so keep-alive
+    connections are reused across messages instead of re-doing TCP/TLS.
+    Created in the FastAPI lifespan and closed on shutdown.
+    """
+
+    NAMES = ("media", "default")
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def start(self):
+        if self._clients:
+            return # already started; replacing the clients would leak their pools
+        http2 = _http2_available()
+        limits = httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        )
+        # WAHA media files: generous read timeout, quick connect failure
+        self._clients["media"] = httpx.AsyncClient(
+            limits=limits,
+            http2=http2,
+            timeout=httpx.Timeout(settings.MEDIA_DOWNLOAD_TIMEOUT, connect=5.0),
+            follow_redirects=True,
+        )
+        # Everything else (health probes, small JSON calls)
+        self._clients["default"] = httpx.AsyncClient(
+            limits=limits,
+            http2=http2,
+            timeout=httpx.Timeout(10.0, connect=3.0),
+        )
+        logger.info(f"🌐 HTTP clients ready (http2={'on' if http2 else 'off'})")
+
+    def get(self, name: str = "default") -> httpx.AsyncClient:
+        if name not in self.NAMES:
+            raise KeyError(f"Unknown HTTP client {name!r} (expected one of {', '.join(self.NAMES)})")
+        if not self._clients:
+            # Scripts and tests that never ran the lifespan still get a working client
+            self.start()
+        return self._clients[name]
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+    def stats(self) -> dict:
+        return {name: pool_stats(client) for name, client in self._clients.items()}
+
+
+http_clients = HTTPClientRegistry()
@@ -0,0 +1,188 @@
+import bisect
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+# Default latency buckets (seconds): sub-millisecond cache hits up to slow LLM calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {} # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        # Non-cumulative per bucket; cumulated at render time to keep observe O(log n)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Minimal in-process Prometheus registry (text exposition format 0.0.4).
+    Hot-path updates are plain dict/list arithmetic on the event loop thread;
+    point-in-time gauges (pools, queues) are sampled by collectors at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()) -> Gauge:
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                pass # a broken gauge must not break the scrape
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram(
+    "aiservice_stage_seconds", "Time spent per processing stage", ["stage"],
+)
+webhook_messages = registry.counter(
+    "aiservice_webhook_messages_total", "WAHA messages processed by the queue workers", ["kind", "outcome"],
+)
+webhook_duplicates = registry.counter(
+    "aiservice_webhook_duplicates_total", "Redelivered WAHA messages skipped, by where they were caught", ["stage"],
+)
+message_batch_size = registry.histogram(
+    "aiservice_message_batch_size", "Messages written per group commit", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+llm_request_seconds = registry.histogram(
+    "aiservice_llm_request_seconds", "LLM provider call latency (cache misses only)", ["provider", "model", "outcome"],
+)
+llm_tokens = registry.counter(
+    "aiservice_llm_tokens_total", "LLM tokens used (provider-reported, estimated when missing)", ["provider", "model", "kind"],
+)
+llm_cost = registry.counter(
+    "aiservice_llm_cost_usd_total", "Estimated LLM spend from LLM_PRICING", ["provider", "model"],
+)
+llm_structured_outputs = registry.counter(
+    "aiservice_llm_structured_outputs_total",
+    "Structured LLM answers by parse outcome (ok, repaired, reasked, failed, llm_error)", ["provider", "kind", "outcome"],
+)
+llm_cache_hits = registry.counter(
+    "aiservice_llm_cache_hits_total", "LLM calls answered from the response cache", ["provider"],
+)
+startup_seconds = registry.gauge(
+    "aiservice_startup_seconds", "Worker startup time by phase (imports, schema, dedup_warm, queue, total)", ["phase"],
+)
+
+
+def stage(name: str):
+    """`with stage("message.commit"):` records the block's duration in aiservice_stage_seconds."""
+    return stage_seconds.time(stage=name)
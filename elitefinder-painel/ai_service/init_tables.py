@@ -1,33 +1,69 @@
-import os
 import asyncio
-from sqlalchemy.ext.asyncio import create_async_engine
-from core.config import settings
-from models.db_models import Base
 
-# Force load Env if needed
+# Force load Env if needed (before core.database reads DATABASE_URL)
 from dotenv import load_dotenv
 load_dotenv()
 
-async def init_db():
-    database_url = settings.DATABASE_URL
-    if not database_url:
-        print("❌ DATABASE_URL not set!")
+from sqlalchemy import inspect, text, Text
+from core.database import engine, DATABASE_URL
+from models.db_models import Base, AnaliseQualidade
+
+def _add_missing_columns(sync_conn):
+    # create_all never alters existing tables; new columns must be nullable or have a default
+    inspector = inspect(sync_conn)
+    ddl = sync_conn.dialect.ddl_compiler(sync_conn.dialect, None)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                print(f"🧩 Adding column {table.name}.{column.name}")
+                sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl.get_column_specification(column)}"))
+
+def _widen_analise_qualidade(sync_conn):
+    # SQL/database.sql declares the quality columns VARCHAR(10/50) NOT NULL, which the ai_service
+    # defaults ("Não identificado") overflow; server/scripts/import_legacy.ts widens them the same way
+    if sync_conn.dialect.name != "postgresql":
         return
+    table = AnaliseQualidade.__table__
+    inspector = inspect(sync_conn)
+    if not inspector.has_table(table.name):
+        return
+    existing = {column["name"]: column for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        current = existing.get(column.name)
+        if current is None or column.primary_key:
+            continue
+        if isinstance(column.type, Text) and not isinstance(current["type"], Text):
+            print(f"🧩 Widening {table.name}.{column.name} to TEXT")
+            sync_conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE TEXT"))
+        if column.nullable and not current["nullable"]:
+            print(f"🧩 Dropping NOT NULL on {table.name}.{column.name}")
+            sync_conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL"))
 
-    # Fix for SQLAlchemy async
-    if database_url.startswith("postgresql://"):
-        database_url = database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+def _create_missing_indexes(sync_conn):
+    # create_all skips indexes on tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
 
-    print(f"🔌 Connecting to: {database_url.split('@')[-1]}") # Hide credentials
-    
-    engine = create_async_engine(database_url, echo=True)
-    
-    async with engine.begin() as conn:
+async def create_schema(bind=engine):
+    """Creates missing tables, columns and indexes on the shared async engine."""
+    async with bind.begin() as conn:
         print("🛠️ Creating tables...")
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_widen_analise_qualidade)
+        await conn.run_sync(_create_missing_indexes)
         print("✅ Tables created successfully!")
 
-    await engine.dispose()
+async def init_db():
+    print(f"🔌 Connecting to: {DATABASE_URL.split('@')[-1]}") # Hide credentials
+    try:
+        await create_schema()
+    finally:
+        await engine.dispose()
 
 if __name__ == "__main__":
     asyncio.run(init_db())
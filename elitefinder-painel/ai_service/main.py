@@ -1,39 +1,135 @@
-from fastapi import FastAPI, Depends
+import time
+_import_started = time.perf_counter() # startup timing: everything below, routers included
+
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Depends, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from core.config import settings
 from core.security import get_api_key
 from core.database import get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from init_tables import create_schema
+    from core.database import engine
+    from core.http import http_clients
+    from services.webhook_queue import webhook_queue
+    from services.message_service import message_service
+    from services.spreadsheet import spreadsheet_processor
+    from services.dedup import seen_messages
+    from services.debouncer import analysis_debouncer
+    from core.metrics import startup_seconds
+
+    clock = time.perf_counter()
+    timings = {"imports": clock - _import_started}
+
+    def lap(phase: str):
+        nonlocal clock
+        now = time.perf_counter()
+        timings[phase] = now - clock
+        clock = now
+
+    # Schema changes are a deploy step (python init_tables.py), not something every worker races to do
+    if settings.AUTO_CREATE_SCHEMA:
+        await create_schema()
+        lap("schema")
+    await seen_messages.warm()
+    lap("dedup_warm")
+    http_clients.start()
+    await webhook_queue.start()
+    lap("queue")
+    timings["total"] = sum(timings.values())
+    for phase, seconds in timings.items():
+        startup_seconds.set(seconds, phase=phase)
+    phases = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in timings.items() if phase != "total")
+    logger.info(f"🚀 Worker ready in {timings['total'] * 1000:.0f} ms ({phases})")
+    yield
+    await webhook_queue.stop()
+    await analysis_debouncer.stop()
+    await message_service.flush()
+    await http_clients.close()
+    spreadsheet_processor.shutdown()
+    await engine.dispose()
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
-    openapi_url=f"{settings.API_V1_STR}/openapi.json"
+    openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    lifespan=lifespan
 )
 
 @app.get("/health")
 def health_check():
     return {"status": "ok", "service": "ai_service"}
 
-@app.on_event("startup")
-async def startup_event():
-    from core.database import engine, Base
-    # Sync engine requires sync call
-    Base.metadata.create_all(bind=engine)
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus scrape endpoint (stage histograms, LLM tokens/cost, pool and queue gauges)."""
+    from core.metrics import registry
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
-from schemas.analysis import AnalysisRequest, AnalysisResponse
-from services.analysis import analyze_conversation
-from services.reports import ReportRequest, ReportResponse, generate_strategic_report
+import json
+from schemas.analysis import AnalysisRequest, AnalysisResponse, BatchAnalysisRequest
+from services.analysis import analyze_conversation, analyze_batch, analyze_ticket, stream_conversation_analysis
+from services.provider_limits import llm_work, set_llm_work
+from services.reports import ReportRequest, ReportResponse, generate_strategic_report, stream_strategic_report, with_rollup_inputs
+
+def _sse(events, tenant_id: int = None, priority: str = "interactive"):
+    """Formats ("token", str) / ("result", model) pairs as Server-Sent Events."""
+    async def body():
+        # Runs in the response's own task, so the LLM scheduling tag is set here
+        set_llm_work(tenant_id, priority)
+        async for event, data in events:
+            payload = data.model_dump_json() if event == "result" else json.dumps({"text": data}, ensure_ascii=False)
+            yield f"event: {event}\ndata: {payload}\n\n"
+    # X-Accel-Buffering stops nginx/Caddy-style proxies from holding the stream
+    return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/analyze", response_model=AnalysisResponse, dependencies=[Depends(get_api_key)])
 @app.post("/analyze", response_model=AnalysisResponse, dependencies=[Depends(get_api_key)])
-async def analyze_endpoint(request: AnalysisRequest, db: Session = Depends(get_db)):
-    return await analyze_conversation(request, db)
+async def analyze_endpoint(request: AnalysisRequest, stream: bool = False, db: AsyncSession = Depends(get_db)):
+    if stream:
+        # The request-scoped session may close before the stream ends; config comes from the cache
+        return _sse(stream_conversation_analysis(request, None), request.tenant_id)
+    with llm_work(request.tenant_id, "interactive"):
+        return await analyze_conversation(request, db)
+
+@app.post("/analyze/ticket/{ticket_id}", response_model=AnalysisResponse, dependencies=[Depends(get_api_key)])
+async def analyze_ticket_endpoint(ticket_id: int, full: bool = False, provider: Optional[str] = None):
+    """Analyzes a stored ticket incrementally from its last analysis; full=true re-analyzes everything."""
+    result = await analyze_ticket(ticket_id, provider=provider, full=full, priority="interactive")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Ticket has no messages")
+    return result
+
+@app.post("/analyze/batch", dependencies=[Depends(get_api_key)])
+async def analyze_batch_endpoint(request: BatchAnalysisRequest):
+    """Streams one AnalysisResponse JSON per line (NDJSON) as each conversation finishes."""
+    if len(request.conversations) > settings.ANALYZE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {settings.ANALYZE_BATCH_MAX_ITEMS} conversations per batch")
+    concurrency = min(request.concurrency or settings.ANALYZE_BATCH_CONCURRENCY, settings.ANALYZE_BATCH_CONCURRENCY)
+
+    async def ndjson():
+        async for result in analyze_batch(request.conversations, concurrency):
+            yield result.model_dump_json() + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
 
 @app.post("/report", response_model=ReportResponse, dependencies=[Depends(get_api_key)])
-async def report_endpoint(request: ReportRequest, db: Session = Depends(get_db)):
-    return await generate_strategic_report(request, db)
+async def report_endpoint(request: ReportRequest, stream: bool = False, from_rollups: bool = False, db: AsyncSession = Depends(get_db)):
+    if from_rollups:
+        request = await with_rollup_inputs(request, db)
+    if stream:
+        return _sse(stream_strategic_report(request, None), request.tenant_id)
+    with llm_work(request.tenant_id, "interactive"):
+        return await generate_strategic_report(request, db)
     
 from routers import webhooks, admin
 app.include_router(webhooks.router, prefix="/webhooks", tags=["Webhooks"])
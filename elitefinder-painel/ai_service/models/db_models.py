@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, ForeignKey, Float, Boolean, JSON, Index
+from sqlalchemy.sql import func, text
 from core.database import Base
 from datetime import datetime
 
@@ -15,6 +15,16 @@ class Atendimento(Base):
     status_atendimento = Column(String(50), default="aberto")
     nome_cliente = Column(String(100), nullable=False)
     telefone_cliente = Column(String(20), nullable=True)
+    id_tenant = Column(Integer, nullable=True) # added by migrate-multitenancy (FK to tenant there)
+
+    __table_args__ = (
+        # Serves "latest open ticket for this phone" (MessageService) on cache misses
+        Index(
+            "ix_atendimento_telefone_aberto",
+            "telefone_cliente", "status_atendimento", "data_hora_inicio",
+            postgresql_where=text("status_atendimento <> 'fechado'"),
+        ),
+    )
 
 class Mensagem(Base):
     __tablename__ = "mensagem"
@@ -25,6 +35,42 @@ class Mensagem(Base):
     data_hora_envio = Column(DateTime(timezone=True), default=func.now(), nullable=False)
     remetente_tipo = Column(String(50), nullable=False) # 'cliente' or 'atendente'
     tipo_analise = Column(String(50), nullable=True)
+    id_externo = Column(String(128), nullable=True) # WAHA message id; NULL for rows not from a webhook
+
+    __table_args__ = (
+        # Redelivered webhooks (message + message.any, WAHA retries) hit this instead of duplicating rows
+        Index("uq_mensagem_id_externo", "id_externo", unique=True),
+    )
+
+class AnaliseQualidade(Base):
+    # Existing table from SQL/database.sql (VARCHAR NOT NULL there), also written by n8n / the painel;
+    # init_tables.py widens the quality columns to nullable TEXT, as server/scripts/import_legacy.ts does
+    __tablename__ = "analisequalidade"
+
+    id_analise = Column(Integer, primary_key=True)
+    id_atendimento = Column(Integer, ForeignKey("atendimento.id_atendimento", ondelete="CASCADE"), nullable=False)
+    saudacao_inicial = Column(Text, nullable=True)
+    uso_nome_cliente = Column(Text, nullable=True)
+    rapport_empatia = Column(Text, nullable=True)
+    uso_emojis = Column(Text, nullable=True)
+    tom_conversa = Column(Text, nullable=True)
+    erros_gramaticais = Column(Text, nullable=True)
+    resolutividade = Column(Text, nullable=True)
+    tempo_resposta = Column(Text, nullable=True)
+    indicios_venda = Column(Text, nullable=True)
+    sentimento_geral = Column(Text, nullable=True)
+    tipo_atendimento = Column(Text, nullable=True)
+    pontuacao_geral = Column(Integer, nullable=True)
+    observacoes = Column(Text, nullable=True)
+    data_analise = Column(DateTime(timezone=True), default=func.now(), nullable=False)
+    canal_origem_conversa = Column(Text, nullable=True)
+    produto_interesse = Column(Text, nullable=True)
+
+    __table_args__ = (
+        # Same names as SQL/database.sql so _create_missing_indexes finds them
+        Index("idx_analise_idatendimento", "id_atendimento"),
+        Index("idx_analise_dataanalise", "data_analise"),
+    )
 
 class AgentConfig(Base):
     __tablename__ = "agent_config"
@@ -36,3 +82,65 @@ class AgentConfig(Base):
     max_tokens = Column(Integer, default=2000)
     system_prompt = Column(Text, nullable=True)
     is_active = Column(Boolean, default=True)
+    updated_at = Column(DateTime(timezone=True), default=func.now(), nullable=True) # version stamp for config caches
+
+class WebhookJob(Base):
+    __tablename__ = "webhook_job"
+
+    id = Column(Integer, primary_key=True, index=True)
+    payload = Column(JSON, nullable=False) # WahaWebhookPayload dumped by alias
+    status = Column(String(20), default="pending", nullable=False) # pending, processing, dead
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime(timezone=True), default=func.now(), nullable=False)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_webhook_job_status_available", "status", "available_at"),
+    )
+
+class LLMCacheEntry(Base):
+    __tablename__ = "llm_cache"
+
+    key = Column(String(64), primary_key=True) # sha256 of provider/model/params/prompts
+    provider = Column(String(50), nullable=False)
+    model = Column(String(100), nullable=False)
+    response = Column(Text, nullable=False)
+    hits = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=func.now(), nullable=False, index=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class MetricRollup(Base):
+    __tablename__ = "metric_rollup_daily"
+
+    # One row per local day / tenant (0 = none) / attendant, incremented as data arrives
+    day = Column(Date, primary_key=True)
+    tenant_id = Column(Integer, primary_key=True, default=0)
+    attendant_id = Column(Integer, primary_key=True)
+    tickets_opened = Column(Integer, default=0, nullable=False)
+    messages_client = Column(Integer, default=0, nullable=False)
+    messages_attendant = Column(Integer, default=0, nullable=False)
+    response_count = Column(Integer, default=0, nullable=False)
+    response_seconds_total = Column(Float, default=0, nullable=False)
+    analyses = Column(Integer, default=0, nullable=False)
+    score_total = Column(Integer, default=0, nullable=False) # sum of pontuacao_geral
+    sentiment_positive = Column(Integer, default=0, nullable=False)
+    sentiment_neutral = Column(Integer, default=0, nullable=False)
+    sentiment_negative = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index("ix_metric_rollup_tenant_day", "tenant_id", "day"),
+    )
+
+class TicketAnalysisState(Base):
+    __tablename__ = "ticket_analysis_state"
+
+    # Rolling analysis per ticket: the next analysis sends this plus messages after last_message_id
+    id_atendimento = Column(Integer, ForeignKey("atendimento.id_atendimento", ondelete="CASCADE"), primary_key=True)
+    last_message_id = Column(Integer, nullable=False)
+    messages_analyzed = Column(Integer, default=0, nullable=False)
+    incremental_runs = Column(Integer, default=0, nullable=False) # since the last full analysis
+    summary = Column(Text, nullable=True)
+    result = Column(JSON, nullable=False) # AnalysisResponse of the latest analysis
+    updated_at = Column(DateTime(timezone=True), default=func.now(), nullable=False)
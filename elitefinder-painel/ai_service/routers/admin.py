@@ -1,8 +1,20 @@
 from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from core.database import get_db
 from models.db_models import AgentConfig
+from services.webhook_queue import webhook_queue
+from services.dedup import seen_messages
+from services.debouncer import analysis_debouncer
+from services.message_service import message_service
+from services.ticket_cache import ticket_cache
+from services.config_cache import agent_config_cache
+from services.provider_limits import provider_limiters
+from services.provider_router import provider_router
+from services.llm_cache import llm_cache
+from services import rollups
+from core.http import http_clients
+from datetime import datetime, timezone
 from pydantic import BaseModel
 from typing import List, Optional
 
@@ -21,13 +33,13 @@ class AgentConfigSchema(BaseModel):
         orm_mode = True
 
 @router.get("/config", response_model=List[AgentConfigSchema])
-async def get_agent_configs(db: Session = Depends(get_db)):
+async def get_agent_configs(db: AsyncSession = Depends(get_db)):
     """Get all agent configurations"""
     result = await db.execute(select(AgentConfig))
     return result.scalars().all()
 
 @router.post("/config", response_model=AgentConfigSchema)
-async def create_or_update_config(config: AgentConfigSchema, db: Session = Depends(get_db)):
+async def create_or_update_config(config: AgentConfigSchema, db: AsyncSession = Depends(get_db)):
     """Create or update an agent configuration"""
     # Check if exists
     result = await db.execute(select(AgentConfig).where(AgentConfig.provider == config.provider))
@@ -39,6 +51,7 @@ async def create_or_update_config(config: AgentConfigSchema, db: Session = Depen
         existing.max_tokens = config.max_tokens
         existing.system_prompt = config.system_prompt
         existing.is_active = config.is_active
+        existing.updated_at = datetime.now(timezone.utc)
     else:
         new_config = AgentConfig(
             provider=config.provider,
@@ -46,9 +59,73 @@ async def create_or_update_config(config: AgentConfigSchema, db: Session = Depen
             temperature=config.temperature,
             max_tokens=config.max_tokens,
             system_prompt=config.system_prompt,
-            is_active=config.is_active
+            is_active=config.is_active,
+            updated_at=datetime.now(timezone.utc)
         )
         db.add(new_config)
     
     await db.commit()
+    # Other workers pick the change up on their next version check
+    agent_config_cache.invalidate()
     return config
+
+@router.get("/queue")
+async def get_queue_stats():
+    """Webhook queue depth per status, plus the duplicate-delivery filter"""
+    return {**await webhook_queue.stats(), "dedup": seen_messages.stats(), "analysis_debounce": analysis_debouncer.stats()}
+
+@router.post("/queue/retry-dead")
+async def retry_dead_jobs():
+    """Re-queue every dead-lettered webhook job"""
+    return {"requeued": await webhook_queue.retry_dead()}
+
+@router.post("/tickets/{ticket_id}/close")
+async def close_ticket(ticket_id: int):
+    """Close a ticket so the next message from that phone opens a new one"""
+    if not await message_service.close_ticket(ticket_id):
+        raise HTTPException(status_code=404, detail="Ticket not found")
+    return {"status": "fechado", "id_atendimento": ticket_id}
+
+@router.get("/tickets/cache")
+async def get_ticket_cache_stats():
+    """Phone -> open ticket cache stats"""
+    return ticket_cache.stats()
+
+@router.get("/llm/limits")
+async def get_llm_limits():
+    """Per-provider concurrency slots and queueing stats"""
+    return {name: limiter.stats() for name, limiter in provider_limiters.items()}
+
+@router.get("/llm/providers")
+async def get_llm_provider_health():
+    """Circuit breaker state, rolling error rate and p95 latency per provider"""
+    return provider_router.stats()
+
+@router.get("/llm/cache")
+async def get_llm_cache_stats():
+    """LLM response cache hit/miss counters"""
+    return llm_cache.stats()
+
+@router.post("/llm/cache/prune")
+async def prune_llm_cache():
+    """Drop expired and over-capacity cache rows"""
+    return {"removed": await llm_cache.prune()}
+
+@router.get("/http")
+async def get_http_pool_stats():
+    """Connection pool utilization of the shared HTTP clients"""
+    return http_clients.stats()
+
+@router.get("/rollups")
+async def get_rollups(tenant_id: int = 0, period: str = "weekly", db: AsyncSession = Depends(get_db)):
+    """Report inputs built from metric_rollup_daily (what /report?from_rollups=true sends to the model)"""
+    start, end = rollups.period_bounds(period)
+    return await rollups.load_report_inputs(db, tenant_id, start, end)
+
+@router.post("/rollups/rebuild")
+async def rebuild_rollups(days: int = 7, db: AsyncSession = Depends(get_db)):
+    """Recompute the last N days of rollups from atendimento/mensagem/analisequalidade"""
+    if days < 1:
+        raise HTTPException(status_code=400, detail="days must be >= 1")
+    start, end = rollups.period_bounds(str(days))
+    return {"from": start, "to": end, "rows": await rollups.rebuild(db, start, end)}
@@ -1,19 +1,35 @@
-from fastapi import APIRouter, HTTPException, Depends, Request, BackgroundTasks
+from fastapi import APIRouter, HTTPException
 from schemas.waha import WahaWebhookPayload
-from services.webhook_processor import process_waha_payload
+from services.webhook_processor import HANDLED_EVENTS
+from services.webhook_queue import webhook_queue, QueueFullError
+from services.dedup import seen_messages
+from core.metrics import webhook_duplicates
 import logging
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 @router.post("/waha")
-async def handle_waha_webhook(payload: WahaWebhookPayload, background_tasks: BackgroundTasks):
+async def handle_waha_webhook(payload: WahaWebhookPayload):
     """
     Receives Webhooks from WAHA (WhatsApp API).
     """
     logger.info(f"📩 Webhook received: {payload.event} from {payload.payload.from_}")
 
-    # Process in background to return 200 OK immediately to WAHA
-    background_tasks.add_task(process_waha_payload, payload)
+    if payload.event not in HANDLED_EVENTS:
+        return {"status": "ignored", "id": payload.payload.id}
+
+    # Already processed (or in progress) here: don't even queue it
+    if payload.payload.id in seen_messages:
+        webhook_duplicates.inc(stage="webhook")
+        return {"status": "duplicate", "id": payload.payload.id}
+
+    # Persist to the durable queue and return 200 OK immediately to WAHA
+    try:
+        await webhook_queue.enqueue(payload)
+    except QueueFullError as e:
+        logger.warning(f"⏳ Backpressure: {e}")
+        # WAHA retries on non-2xx, so the message is delayed instead of lost
+        raise HTTPException(status_code=503, detail="Webhook queue is full", headers={"Retry-After": "5"})
     
     return {"status": "queued", "id": payload.payload.id}
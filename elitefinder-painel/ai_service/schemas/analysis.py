@@ -11,6 +11,7 @@ class AnalysisRequest(BaseModel):
     messages: List[Message]
     context: Optional[str] = None
     provider: Optional[str] = "openai"
+    tenant_id: Optional[int] = None # LLM fair scheduling (see services/provider_limits.py)
 
 class AnalysisResponse(BaseModel):
     conversation_id: str
@@ -22,6 +23,10 @@ class AnalysisResponse(BaseModel):
     suggestion: Optional[str] = None
     risk_level: str = "Baixo" # Baixo, Medio, Alto
 
+class BatchAnalysisRequest(BaseModel):
+    conversations: List[AnalysisRequest]
+    concurrency: Optional[int] = Field(None, ge=1, description="Overrides ANALYZE_BATCH_CONCURRENCY (capped by it)")
+
 class StrategyRequest(BaseModel):
     attendant_id: str
     metrics: Dict[str, Any]
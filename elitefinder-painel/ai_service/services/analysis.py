@@ -1,63 +1,323 @@
+import asyncio
 import json
+import logging
+from typing import Any, AsyncIterator, List, Optional, Tuple
+from datetime import datetime, timezone
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from core.config import settings
+from core.database import SessionLocal, engine
+from core.metrics import registry, stage
+from models.db_models import Atendimento, Mensagem, TicketAnalysisState
 from services.llm import llm_service
-from schemas.analysis import AnalysisRequest, AnalysisResponse
+from services.provider_limits import llm_work
+from services.structured import StructuredOutputError, complete_structured, parse_structured
+from services.transcript import Turn, collapse_turns, render_transcript, transcript_tokens, chunk_turns
+from schemas.analysis import AnalysisRequest, AnalysisResponse, Message
 
+logger = logging.getLogger(__name__)
 
-async def analyze_conversation(request: AnalysisRequest, db) -> AnalysisResponse:
+_ticket_analyses = registry.counter(
+    "aiservice_ticket_analyses_total", "analyze_ticket runs by mode (full, incremental, unchanged)", ["mode"],
+)
+
+# Shared tail of every analysis prompt (single, reduce, incremental)
+ANALYSIS_JSON_FORMAT = """Responda EXCLUSIVAMENTE em JSON no seguinte formato:
+    {
+        "score": <0-100>,
+        "sentiment": "<Muito Positivo|Positivo|Neutro|Negativo|Muito Negativo>",
+        "summary": "<Resumo executivo do que ocorreu>",
+        "strengths": ["<Ponto 1>", "<Ponto 2>"],
+        "weaknesses": ["<Ponto 1>", "<Ponto 2>"],
+        "suggestion": "<Sugestão tática imediata>",
+        "risk_level": "<Baixo|Alto>"
+    }"""
+
+# Fields the model may leave out; anything else missing or malformed triggers a repair
+ANALYSIS_DEFAULTS = {
+    "score": 0,
+    "sentiment": "Neutro",
+    "summary": "",
+    "strengths": [],
+    "weaknesses": [],
+    "risk_level": "Baixo",
+}
+
+
+def build_analysis_prompt(request: AnalysisRequest, turns: List[Turn] = None, context: str = None) -> str:
     # 1. Prepare Transcript
-    transcript = ""
-    for msg in request.messages:
-        transcript += f"{msg.role}: {msg.content}\n"
+    if turns is None:
+        turns = collapse_turns(request.messages, settings.TRANSCRIPT_MAX_TURN_TOKENS)
+    transcript = render_transcript(turns)
 
-    # ... (Prompt building omitted for brevity, assuming it's unchanged) ...
-    prompt = f"""
+    return f"""
     Você é um Auditor de Qualidade Sênior. Analise a seguinte conversa.
     
-    CONTEXTO: {request.context or 'Atendimento ao cliente'}
+    CONTEXTO: {context or request.context or 'Atendimento ao cliente'}
     
     TRANSCRICAO:
     {transcript}
     
     Sua tarefa é extrair insights profundos.
-    Responda EXCLUSIVAMENTE em JSON no seguinte formato:
-    {{
-        "score": <0-100>,
-        "sentiment": "<Muito Positivo|Positivo|Neutro|Negativo|Muito Negativo>",
-        "summary": "<Resumo executivo do que ocorreu>",
-        "strengths": ["<Ponto 1>", "<Ponto 2>"],
-        "weaknesses": ["<Ponto 1>", "<Ponto 2>"],
-        "suggestion": "<Sugestão tática imediata>",
-        "risk_level": "<Baixo|Alto>"
-    }}
+    {ANALYSIS_JSON_FORMAT}
+    """
+
+
+def build_reduce_prompt(request: AnalysisRequest, partials: List[AnalysisResponse]) -> str:
+    """Merges per-chunk analyses of a long conversation into one final analysis."""
+    sections = "\n    ".join(
+        f"TRECHO {i + 1}: " + json.dumps(partial.model_dump(exclude={"conversation_id"}), ensure_ascii=False)
+        for i, partial in enumerate(partials)
+    )
+
+    return f"""
+    Você é um Auditor de Qualidade Sênior. Uma conversa longa foi analisada em trechos consecutivos.
+    Consolide as análises parciais abaixo em uma única avaliação da conversa inteira.
+    
+    CONTEXTO: {request.context or 'Atendimento ao cliente'}
+    
+    ANALISES PARCIAIS (em ordem cronológica):
+    {sections}
+    
+    Dê mais peso ao desfecho (trechos finais) e elimine pontos repetidos.
+    {ANALYSIS_JSON_FORMAT}
     """
+
+
+def build_incremental_prompt(request: AnalysisRequest, previous: AnalysisResponse, messages_analyzed: int, turns: List[Turn]) -> str:
+    """Updates a stored analysis with only the messages that arrived after it."""
+    previous_json = json.dumps(previous.model_dump(exclude={"conversation_id"}), ensure_ascii=False)
+
+    return f"""
+    Você é um Auditor de Qualidade Sênior. Esta conversa já foi analisada até a mensagem {messages_analyzed}.
+    Atualize a análise para a conversa inteira usando a análise anterior como memória do que já ocorreu.
     
-    # 3. Call LLM (Using OpenAI/Anthropic for Analysis)
-    # Use provider from request, default to openai
-    response_text = await llm_service.analyze_conversation(db, prompt, provider=request.provider or "openai")
+    CONTEXTO: {request.context or 'Atendimento ao cliente'}
+    
+    ANALISE ANTERIOR:
+    {previous_json}
+    
+    NOVAS MENSAGENS:
+    {render_transcript(turns)}
     
-    # 4. Parse JSON
+    Mantenha os pontos anteriores que continuam válidos, ajuste score e sentimento ao desfecho atual
+    e reescreva o resumo cobrindo a conversa toda.
+    {ANALYSIS_JSON_FORMAT}
+    """
+
+
+async def _map_chunks(request: AnalysisRequest, chunks: List[List[Turn]], db) -> List[AnalysisResponse]:
+    """Analyzes each chunk concurrently (provider caps still apply) and keeps the usable results in order."""
+    semaphore = asyncio.Semaphore(settings.ANALYSIS_MAP_CONCURRENCY)
+    base_context = request.context or 'Atendimento ao cliente'
+
+    async def run(index: int, turns: List[Turn]) -> AnalysisResponse:
+        context = f"{base_context} (trecho {index + 1} de {len(chunks)} de uma conversa longa)"
+        async with semaphore:
+            text = await llm_service.analyze_conversation(db, build_analysis_prompt(request, turns, context), provider=request.provider or "openai", json_mode=True)
+        # No re-ask here: a lost chunk is dropped, the reduce step copes with fewer partials
+        return parse_analysis_response(request.conversation_id, text)
+
+    results = await asyncio.gather(*(run(i, turns) for i, turns in enumerate(chunks)))
+    return [result for result in results if result.sentiment != "Erro"]
+
+
+async def prepare_analysis_prompt(request: AnalysisRequest, db) -> str:
+    """
+    Returns the prompt for the final analysis call. Conversations within
+    TRANSCRIPT_TOKEN_BUDGET are sent whole; longer ones are split into
+    TRANSCRIPT_CHUNK_TOKENS chunks, analyzed in parallel (map) and merged
+    by a reduce prompt.
+    """
+    turns = collapse_turns(request.messages, settings.TRANSCRIPT_MAX_TURN_TOKENS)
+    tokens = transcript_tokens(turns)
+    if tokens <= settings.TRANSCRIPT_TOKEN_BUDGET:
+        return build_analysis_prompt(request, turns)
+
+    chunks = chunk_turns(turns, settings.TRANSCRIPT_CHUNK_TOKENS)
+    logger.info(f"✂️ Conversation {request.conversation_id}: ~{tokens} tokens, map-reduce over {len(chunks)} chunks")
+    partials = await _map_chunks(request, chunks, db)
+    if not partials:
+        # Every map call failed: fall back to the most recent chunk, which holds the outcome
+        return build_analysis_prompt(request, chunks[-1])
+    return build_reduce_prompt(request, partials)
+
+
+def _analysis_error(conversation_id: str) -> AnalysisResponse:
+    return AnalysisResponse(
+        conversation_id=conversation_id,
+        score=0,
+        sentiment="Erro",
+        summary="Falha no processamento da IA",
+        strengths=[],
+        weaknesses=[],
+        risk_level="Desconhecido"
+    )
+
+
+def parse_analysis_response(conversation_id: str, response_text: str) -> AnalysisResponse:
     try:
-        clean_text = response_text.replace("```json", "").replace("```", "").strip()
-        data = json.loads(clean_text)
-        
-        return AnalysisResponse(
-            conversation_id=request.conversation_id,
-            score=data.get("score", 0),
-            sentiment=data.get("sentiment", "Neutro"),
-            summary=data.get("summary", ""),
-            strengths=data.get("strengths", []),
-            weaknesses=data.get("weaknesses", []),
-            suggestion=data.get("suggestion"),
-            risk_level=data.get("risk_level", "Baixo")
-        )
-    except Exception as e:
-        print(f"Error parsing analysis: {e}")
-        return AnalysisResponse(
-            conversation_id=request.conversation_id,
-            score=0,
-            sentiment="Erro",
-            summary="Falha no processamento da IA",
-            strengths=[],
-            weaknesses=[],
-            risk_level="Desconhecido"
+        return parse_structured(response_text, AnalysisResponse, ANALYSIS_DEFAULTS, conversation_id=conversation_id)
+    except StructuredOutputError as e:
+        logger.warning(f"Error parsing analysis: {e}")
+        return _analysis_error(conversation_id)
+
+
+async def parse_analysis_output(request: AnalysisRequest, response_text: str, db) -> AnalysisResponse:
+    """Like parse_analysis_response, but re-asks the model once with a repair prompt before giving up."""
+    provider = request.provider or "openai"
+
+    async def reask(repair_prompt: str) -> str:
+        return await llm_service.analyze_conversation(db, repair_prompt, provider=provider, json_mode=True)
+
+    try:
+        return await complete_structured(
+            response_text, AnalysisResponse, kind="analysis", provider=provider,
+            reask=reask if settings.LLM_REPAIR_REASK else None,
+            defaults=ANALYSIS_DEFAULTS, conversation_id=request.conversation_id,
         )
+    except StructuredOutputError as e:
+        logger.warning(f"Error parsing analysis: {e}")
+        return _analysis_error(request.conversation_id)
+
+
+async def analyze_conversation(request: AnalysisRequest, db) -> AnalysisResponse:
+    with stage("analysis.prepare"): # includes the map step for long conversations
+        prompt = await prepare_analysis_prompt(request, db)
+    
+    # Call LLM (Using OpenAI/Anthropic for Analysis)
+    # Use provider from request, default to openai
+    with stage("analysis.llm"):
+        response_text = await llm_service.analyze_conversation(db, prompt, provider=request.provider or "openai", json_mode=True)
+    
+    with stage("analysis.parse"):
+        return await parse_analysis_output(request, response_text, db)
+
+
+async def _ticket_messages(db, ticket_id: int, after_id: int = 0) -> List[tuple]:
+    result = await db.execute(
+        select(Mensagem.id_mensagem, Mensagem.remetente_tipo, Mensagem.conteudo_texto)
+        .where(Mensagem.id_atendimento == ticket_id, Mensagem.id_mensagem > after_id)
+        .order_by(Mensagem.data_hora_envio, Mensagem.id_mensagem)
+    )
+    return result.all()
+
+
+async def _save_ticket_state(ticket_id: int, last_message_id: int, messages_analyzed: int, incremental_runs: int, result: AnalysisResponse):
+    values = {
+        "id_atendimento": ticket_id,
+        "last_message_id": last_message_id,
+        "messages_analyzed": messages_analyzed,
+        "incremental_runs": incremental_runs,
+        "summary": result.summary,
+        "result": result.model_dump(mode="json"),
+        "updated_at": datetime.now(timezone.utc),
+    }
+    dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(TicketAnalysisState).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TicketAnalysisState.id_atendimento],
+        set_={key: stmt.excluded[key] for key in values if key != "id_atendimento"},
+        # An older analysis finishing late must not roll the state back
+        where=TicketAnalysisState.last_message_id <= stmt.excluded.last_message_id,
+    )
+    async with SessionLocal() as db:
+        await db.execute(stmt)
+        await db.commit()
+
+
+async def analyze_ticket(ticket_id: int, provider: str = None, full: bool = False, priority: str = "background") -> Optional[AnalysisResponse]:
+    """
+    Analyzes a stored ticket's conversation and keeps its ticket_analysis_state.
+    With a stored state only the messages after last_message_id are sent, along
+    with the previous result (incremental); no new messages means no LLM call.
+    full=True, ANALYSIS_FULL_EVERY incremental runs, or a delta larger than
+    TRANSCRIPT_TOKEN_BUDGET re-analyze the whole conversation instead.
+    LLM calls are scheduled under the ticket's tenant with the given priority.
+    """
+    provider = provider or settings.ANALYSIS_TRIGGER_PROVIDER
+    async with SessionLocal() as db:
+        tenant_id = await db.scalar(select(Atendimento.id_tenant).where(Atendimento.id_atendimento == ticket_id))
+        state = None
+        if settings.ANALYSIS_INCREMENTAL and not full:
+            state = await db.get(TicketAnalysisState, ticket_id)
+
+        rows = await _ticket_messages(db, ticket_id, state.last_message_id if state else 0)
+        if state is not None and not rows:
+            _ticket_analyses.inc(mode="unchanged")
+            return AnalysisResponse(**state.result)
+
+        turns = collapse_turns([Message(role=sender, content=text or "") for _, sender, text in rows], settings.TRANSCRIPT_MAX_TURN_TOKENS)
+        if state is not None and (
+            state.incremental_runs >= settings.ANALYSIS_FULL_EVERY
+            or transcript_tokens(turns) > settings.TRANSCRIPT_TOKEN_BUDGET
+        ):
+            state = None
+            rows = await _ticket_messages(db, ticket_id)
+    if not rows:
+        return None
+
+    request = AnalysisRequest(
+        conversation_id=str(ticket_id),
+        messages=[Message(role=sender, content=text or "") for _, sender, text in rows],
+        provider=provider,
+        tenant_id=tenant_id,
+    )
+    with llm_work(tenant_id, priority):
+        if state is None:
+            _ticket_analyses.inc(mode="full")
+            result = await analyze_conversation(request, None)
+            messages_analyzed, incremental_runs = len(rows), 0
+        else:
+            _ticket_analyses.inc(mode="incremental")
+            previous = AnalysisResponse(**state.result)
+            with stage("analysis.llm"):
+                text = await llm_service.analyze_conversation(
+                    None, build_incremental_prompt(request, previous, state.messages_analyzed, turns), provider=provider, json_mode=True
+                )
+            with stage("analysis.parse"):
+                result = await parse_analysis_output(request, text, None)
+            messages_analyzed, incremental_runs = state.messages_analyzed + len(rows), state.incremental_runs + 1
+
+    if result.sentiment != "Erro":
+        await _save_ticket_state(ticket_id, max(row[0] for row in rows), messages_analyzed, incremental_runs, result)
+    return result
+
+
+async def stream_conversation_analysis(request: AnalysisRequest, db) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Yields ("token", text) for each provider chunk, then ("result", AnalysisResponse)
+    parsed (and repaired if needed) from the full completion. Long conversations run their map step
+    before the first token; only the final (reduce) call is streamed.
+    """
+    prompt = await prepare_analysis_prompt(request, db)
+    chunks = []
+    async for chunk in llm_service.stream_analysis(db, prompt, provider=request.provider or "openai", json_mode=True):
+        chunks.append(chunk)
+        yield "token", chunk
+    # A repair re-ask, if needed, is not streamed
+    yield "result", await parse_analysis_output(request, "".join(chunks), db)
+
+
+async def analyze_batch(requests: List[AnalysisRequest], concurrency: int) -> AsyncIterator[AnalysisResponse]:
+    """
+    Runs many analyses with at most `concurrency` in flight and yields each
+    result as soon as it finishes (completion order, not request order).
+    Provider-level concurrency/RPM caps still apply inside llm_service.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(request: AnalysisRequest) -> AnalysisResponse:
+        async with semaphore:
+            with llm_work(request.tenant_id, "batch"):
+                # No request-scoped session: config comes from the shared cache
+                return await analyze_conversation(request, None)
+
+    tasks = [asyncio.create_task(run(request)) for request in requests]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # Client went away or the stream finished: drop whatever is still queued
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import select, insert, exists
+
+from core.config import settings
+from core.database import SessionLocal
+from models.db_models import Atendimento, Mensagem, AnaliseQualidade
+from schemas.analysis import Message
+from services.llm import llm_service
+from services.provider_limits import llm_work
+from services.rollups import record_analyses
+from services.structured import StructuredOutputError, extract_json
+from services.transcript import collapse_turns, fit_turns, render_transcript
+
+logger = logging.getLogger(__name__)
+
+# Tickets closed by the painel use 'Fechado', ai_service uses 'fechado'
+CLOSED_STATUSES = ("Fechado", "fechado")
+
+# Same fallbacks as the n8n "Processar Resposta IA" node
+QUALITY_DEFAULTS = {
+    "saudacao_inicial": "Não identificado",
+    "uso_nome_cliente": "Não",
+    "rapport_empatia": "Baixo",
+    "uso_emojis": "Não",
+    "tom_conversa": "Neutro",
+    "erros_gramaticais": "Não detectado",
+    "resolutividade": "Não",
+    "tempo_resposta": "Médio",
+    "indicios_venda": "Não",
+    "sentimento_geral": "Neutro",
+    "tipo_atendimento": "Geral",
+    "canal_origem_conversa": "Não identificado",
+    "produto_interesse": "Não especificado",
+    "observacoes": "",
+}
+
+
+@dataclass
+class BacklogTicket:
+    id_atendimento: int
+    nome_cliente: str
+    data_hora_inicio: datetime
+    id_tenant: Optional[int] = None
+    messages: List[Message] = field(default_factory=list)
+
+
+def build_quality_prompt(ticket: BacklogTicket) -> str:
+    """The nightly n8n prompt, fed an ordered transcript instead of STRING_AGG(DISTINCT ...)."""
+    turns = fit_turns(
+        collapse_turns(ticket.messages, settings.TRANSCRIPT_MAX_TURN_TOKENS),
+        settings.TRANSCRIPT_TOKEN_BUDGET,
+    )
+    return f"""Você é um Analista de Qualidade de Atendimento. Avalie a conversa do WhatsApp abaixo:
+
+**Cliente**: {ticket.nome_cliente}
+**Data**: {ticket.data_hora_inicio}
+
+**CONVERSA:**
+{render_transcript(turns)}
+---
+
+RETORNE EXATAMENTE ESTE JSON (sem comentários, sem markdown):
+{{
+  "saudacao_inicial": "descrição breve da saudação",
+  "uso_nome_cliente": "sim ou nao",
+  "rapport_empatia": "Alto, Médio ou Baixo",
+  "uso_emojis": "sim ou nao",
+  "tom_conversa": "descrição breve",
+  "erros_gramaticais": "lista ou Nenhum",
+  "resolutividade": "sim, nao ou parcial",
+  "tempo_resposta": "Rápido, Lento ou Irregular",
+  "indicios_venda": "sim ou nao",
+  "sentimento_geral": "Positivo, Neutro ou Negativo",
+  "tipo_atendimento": "Dúvida, Reclamação, Suporte Técnico ou Vendas",
+  "canal_origem_conversa": "Instagram, Facebook, Google, Site, Indicação, WhatsApp Direto ou Não identificado",
+  "produto_interesse": "Nome do produto mencionado ou Não especificado",
+  "pontuacao_geral": 8,
+  "observacoes": "3 ou mais frases com pontos fortes e fracos"
+}}"""
+
+
+def parse_quality_response(ticket_id: int, response_text: str) -> Optional[dict]:
+    """Maps the model output to an analisequalidade row, or None when it is not usable JSON."""
+    try:
+        data = extract_json(response_text, objects_only=True)
+    except StructuredOutputError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    row = {"id_atendimento": ticket_id}
+    for column, default in QUALITY_DEFAULTS.items():
+        value = data.get(column)
+        if isinstance(value, list):
+            value = ", ".join(str(v) for v in value)
+        row[column] = str(value) if value not in (None, "") else default
+    try:
+        row["pontuacao_geral"] = int(float(data.get("pontuacao_geral") or 0))
+    except (TypeError, ValueError):
+        row["pontuacao_geral"] = 0
+    return row
+
+
+class Checkpoint:
+    """
+    JSON file with the highest ticket id below which every ticket has been handled.
+    Tickets that already have an analysis are filtered by the query anyway, so the
+    checkpoint mostly saves re-scanning and re-trying failures on resume.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_id = 0
+        self.analyzed = 0
+        self.failed: List[int] = []
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+        self.last_id = data.get("last_id", 0)
+        self.analyzed = data.get("analyzed", 0)
+        self.failed = data.get("failed", [])
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "last_id": self.last_id,
+                "analyzed": self.analyzed,
+                "failed": self.failed[-1000:],
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }, f)
+        os.replace(tmp, self.path) # atomic, a crash never leaves a half-written checkpoint
+
+    def reset(self):
+        self.last_id, self.analyzed, self.failed = 0, 0, []
+
+
+class BacklogAnalyzer:
+    """
+    Analyzes closed tickets that have no analisequalidade row.
+    A producer walks atendimento by keyset pagination and loads each page's
+    messages in one ordered query, a worker pool calls the LLM, and a writer
+    inserts results in batches and advances the checkpoint to the lowest
+    ticket id still in flight.
+    """
+
+    def __init__(self, concurrency: int = None, page_size: int = None, write_batch: int = None,
+                 provider: str = None, checkpoint_path: str = None):
+        self.concurrency = concurrency or settings.BACKLOG_CONCURRENCY
+        self.page_size = page_size or settings.BACKLOG_PAGE_SIZE
+        self.write_batch = write_batch or settings.BACKLOG_WRITE_BATCH
+        self.provider = provider or settings.BACKLOG_PROVIDER
+        self.checkpoint = Checkpoint(checkpoint_path or settings.BACKLOG_CHECKPOINT_PATH)
+        self._inflight: set = set()
+        self._fetched_up_to = 0
+
+    async def _fetch_page(self, after_id: int) -> List[BacklogTicket]:
+        async with SessionLocal() as db:
+            result = await db.execute(
+                select(Atendimento.id_atendimento, Atendimento.nome_cliente, Atendimento.data_hora_inicio, Atendimento.id_tenant)
+                .where(
+                    Atendimento.id_atendimento > after_id,
+                    Atendimento.status_atendimento.in_(CLOSED_STATUSES),
+                    ~exists().where(AnaliseQualidade.id_atendimento == Atendimento.id_atendimento),
+                )
+                .order_by(Atendimento.id_atendimento)
+                .limit(self.page_size)
+            )
+            tickets = {row.id_atendimento: BacklogTicket(*row) for row in result.all()}
+            if not tickets:
+                return []
+
+            messages = await db.execute(
+                select(Mensagem.id_atendimento, Mensagem.remetente_tipo, Mensagem.conteudo_texto)
+                .where(Mensagem.id_atendimento.in_(tickets.keys()))
+                .order_by(Mensagem.id_atendimento, Mensagem.data_hora_envio, Mensagem.id_mensagem)
+            )
+            for ticket_id, sender, text in messages.all():
+                tickets[ticket_id].messages.append(Message(role=sender, content=text or ""))
+        return list(tickets.values())
+
+    async def _produce(self, queue: asyncio.Queue, limit: Optional[int]):
+        after_id, queued = self.checkpoint.last_id, 0
+        while limit is None or queued < limit:
+            page = await self._fetch_page(after_id)
+            if not page:
+                break
+            for ticket in page:
+                if limit is not None and queued >= limit:
+                    break
+                self._inflight.add(ticket.id_atendimento)
+                self._fetched_up_to = ticket.id_atendimento
+                await queue.put(ticket)
+                queued += 1
+            after_id = page[-1].id_atendimento
+        return queued
+
+    async def _analyze(self, ticket: BacklogTicket) -> Optional[dict]:
+        if not ticket.messages:
+            return None
+        # Batch priority: live /analyze and webhook work go first, tenants share fairly
+        with llm_work(ticket.id_tenant, "batch"):
+            text = await llm_service.analyze_conversation(None, build_quality_prompt(ticket), provider=self.provider, json_mode=True)
+        return parse_quality_response(ticket.id_atendimento, text)
+
+    async def _work(self, queue: asyncio.Queue, results: asyncio.Queue):
+        while True:
+            ticket = await queue.get()
+            try:
+                row = await self._analyze(ticket)
+            except Exception as e:
+                logger.error(f"❌ Backlog ticket {ticket.id_atendimento} failed: {e}")
+                row = None
+            await results.put((ticket.id_atendimento, row))
+            queue.task_done()
+
+    async def _insert(self, rows: List[dict]):
+        now = datetime.now(timezone.utc)
+        async with SessionLocal() as db:
+            await db.execute(insert(AnaliseQualidade), [{**row, "data_analise": now} for row in rows])
+            try:
+                async with db.begin_nested():
+                    await record_analyses(db, rows)
+            except Exception as e:
+                logger.error(f"⚠️ Rollup update failed for {len(rows)} analyses (use /admin/rollups/rebuild): {e}")
+            await db.commit()
+
+    async def _insert_each(self, analyzed: List[tuple]) -> set:
+        """Inserts (ticket_id, row) pairs one per transaction; returns the ticket ids the database rejected."""
+        rejected = set()
+        for ticket_id, row in analyzed:
+            try:
+                await self._insert([row])
+            except Exception as e:
+                logger.error(f"❌ Backlog ticket {ticket_id} could not be saved: {e}")
+                rejected.add(ticket_id)
+        return rejected
+
+    async def _flush(self, done: List[tuple]):
+        analyzed = [(ticket_id, row) for ticket_id, row in done if row is not None]
+        rejected = set()
+        if analyzed:
+            try:
+                await self._insert([row for _, row in analyzed])
+            except Exception as e:
+                if len(analyzed) == 1:
+                    logger.error(f"❌ Backlog ticket {analyzed[0][0]} could not be saved: {e}")
+                    rejected.add(analyzed[0][0])
+                else:
+                    # One row the database rejects must not stop the run or redo the whole batch
+                    logger.warning(f"⚠️ Backlog batch of {len(analyzed)} analyses failed ({e}); saving them one by one")
+                    rejected = await self._insert_each(analyzed)
+
+        for ticket_id, row in done:
+            self._inflight.discard(ticket_id)
+            if row is None or ticket_id in rejected:
+                self.checkpoint.failed.append(ticket_id)
+        self.checkpoint.analyzed += len(analyzed) - len(rejected)
+        # Everything below the oldest in-flight ticket is settled
+        self.checkpoint.last_id = min(self._inflight) - 1 if self._inflight else self._fetched_up_to
+        self.checkpoint.save()
+
+    async def _write(self, results: asyncio.Queue):
+        buffer = []
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            buffer.append(item)
+            if len(buffer) >= self.write_batch:
+                await self._flush(buffer)
+                buffer = []
+        if buffer:
+            await self._flush(buffer)
+
+    async def run(self, limit: int = None, resume: bool = True) -> dict:
+        if resume:
+            self.checkpoint.load()
+        else:
+            self.checkpoint.reset()
+        self._fetched_up_to = self.checkpoint.last_id
+        started = time.monotonic()
+        analyzed_before, failed_before = self.checkpoint.analyzed, len(self.checkpoint.failed)
+        logger.info(f"🌙 Backlog analysis starting after ticket {self.checkpoint.last_id} ({self.concurrency} workers, provider {self.provider})")
+
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results = asyncio.Queue()
+        workers = [asyncio.create_task(self._work(queue, results)) for _ in range(self.concurrency)]
+        writer = asyncio.create_task(self._write(results))
+        try:
+            queued = await self._produce(queue, limit)
+            await queue.join()
+            await results.put(None)
+            await writer
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if not writer.done():
+                writer.cancel()
+
+        summary = {
+            "queued": queued,
+            "analyzed": self.checkpoint.analyzed - analyzed_before,
+            "failed": len(self.checkpoint.failed) - failed_before,
+            "last_id": self.checkpoint.last_id,
+            "seconds": round(time.monotonic() - started, 1),
+        }
+        logger.info(f"✅ Backlog analysis finished: {summary}")
+        return summary
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from sqlalchemy import select, func
+
+from core.config import settings
+from core.database import SessionLocal
+from models.db_models import AgentConfig
+
+
+@dataclass(frozen=True)
+class ProviderConfig:
+    """Detached, immutable copy of an agent_config row."""
+    provider: str
+    model: str
+    temperature: float
+    max_tokens: int
+    system_prompt: Optional[str]
+    is_active: bool
+
+
+class AgentConfigCache:
+    """
+    Process-local cache of the agent_config table.
+    After AGENT_CONFIG_CACHE_TTL_SECONDS the cache runs a single aggregate query
+    (max(updated_at), count) as a version stamp and only reloads the rows when it
+    changed, so every uvicorn worker converges shortly after POST /admin/config.
+    The worker that handled the write invalidates immediately.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._configs: Dict[str, ProviderConfig] = {}
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+        self.reloads = 0
+
+    async def get(self, db, provider: str) -> Optional[ProviderConfig]:
+        if self._is_stale():
+            await self._refresh(db)
+        return self._configs.get(provider)
+
+    def invalidate(self):
+        self._version = None
+        self._checked_at = 0.0
+
+    def _is_stale(self) -> bool:
+        return time.monotonic() - self._checked_at >= self.ttl_seconds
+
+    async def _refresh(self, db):
+        async with self._lock:
+            if not self._is_stale(): # another task refreshed while we waited
+                return
+            if db is None:
+                async with SessionLocal() as own_db:
+                    await self._load(own_db)
+            else:
+                await self._load(db)
+            self._checked_at = time.monotonic()
+
+    async def _load(self, db):
+        result = await db.execute(select(func.max(AgentConfig.updated_at), func.count(AgentConfig.id)))
+        version = tuple(result.one())
+        if version == self._version:
+            return
+        result = await db.execute(select(AgentConfig))
+        self._configs = {
+            row.provider: ProviderConfig(
+                provider=row.provider,
+                model=row.model,
+                temperature=row.temperature,
+                max_tokens=row.max_tokens,
+                system_prompt=row.system_prompt,
+                is_active=row.is_active,
+            )
+            for row in result.scalars().all()
+        }
+        self._version = version
+        self.reloads += 1
+
+
+agent_config_cache = AgentConfigCache(settings.AGENT_CONFIG_CACHE_TTL_SECONDS)
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable
+
+from core.config import settings
+from core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+_triggers = registry.counter(
+    "aiservice_analysis_triggers_total", "Per-chat analysis triggers (message = coalesced input, fired = LLM analyses)", ["outcome"],
+)
+
+
+@dataclass
+class _Burst:
+    first_at: float
+    last_at: float
+    messages: int = 1
+
+
+class ConversationDebouncer:
+    """
+    Coalesces per-conversation triggers: every touch() pushes the chat's deadline
+    to `idle` seconds after its latest message (but never beyond `max_wait` after
+    the first), and the callback runs once per burst with the number of messages
+    it absorbed. One sleeping task per active chat; nothing is cancelled on touch.
+    """
+
+    def __init__(self, callback: Callable[[Hashable, int], Awaitable[None]], idle: float, max_wait: float):
+        self.callback = callback
+        self.idle = idle
+        self.max_wait = max_wait
+        self._bursts: Dict[Hashable, _Burst] = {}
+        self._tasks = set()
+
+    def touch(self, key: Hashable):
+        now = time.monotonic()
+        _triggers.inc(outcome="message")
+        burst = self._bursts.get(key)
+        if burst is not None:
+            burst.last_at = now
+            burst.messages += 1
+            return
+        self._bursts[key] = _Burst(first_at=now, last_at=now)
+        task = asyncio.create_task(self._wait(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _wait(self, key: Hashable):
+        while True:
+            burst = self._bursts[key]
+            due = min(burst.last_at + self.idle, burst.first_at + self.max_wait)
+            delay = due - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        # Messages arriving while the callback runs open a new burst
+        burst = self._bursts.pop(key)
+        _triggers.inc(outcome="fired")
+        try:
+            await self.callback(key, burst.messages)
+        except Exception as e:
+            _triggers.inc(outcome="error")
+            logger.error(f"❌ Debounced analysis of {key} failed: {e}")
+
+    async def stop(self):
+        """Drops bursts still waiting (no LLM calls during shutdown) and cancels running callbacks."""
+        if self._bursts:
+            logger.info(f"⏹️ Dropping {len(self._bursts)} pending analysis triggers")
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._bursts.clear()
+
+    def stats(self) -> dict:
+        return {"pending_chats": len(self._bursts), "pending_messages": sum(b.messages for b in self._bursts.values())}
+
+
+async def _analyze_burst(ticket_id: int, messages: int):
+    # Imported here: services.analysis pulls in the LLM clients
+    from services.analysis import analyze_ticket
+    result = await analyze_ticket(ticket_id)
+    if result is not None:
+        logger.info(f"🧠 Ticket {ticket_id} analyzed after {messages} message(s): score {result.score}, {result.sentiment}, risk {result.risk_level}")
+
+
+analysis_debouncer = ConversationDebouncer(
+    _analyze_burst,
+    idle=settings.ANALYSIS_DEBOUNCE_SECONDS,
+    max_wait=settings.ANALYSIS_DEBOUNCE_MAX_WAIT_SECONDS,
+)
+
+_pending = registry.gauge("aiservice_analysis_debounce_pending", "Chats waiting for their debounced analysis")
+registry.add_collector(lambda: _pending.set(len(analysis_debouncer._bursts)))
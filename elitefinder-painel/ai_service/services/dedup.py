@@ -0,0 +1,72 @@
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from core.config import settings
+from core.database import SessionLocal
+from models.db_models import Mensagem
+
+logger = logging.getLogger(__name__)
+
+
+class SeenMessages:
+    """
+    Bounded LRU of WAHA message ids this process has processed or is processing.
+    WAHA sends both `message` and `message.any` for the same message and retries
+    on timeouts; the set turns those redeliveries into a dict lookup. What it
+    cannot know (other workers, ids evicted or lost on restart) is caught by the
+    unique mensagem.id_externo index.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self.duplicates = 0
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def claim(self, message_id: str) -> bool:
+        """Marks the id as taken; False when it already was (a duplicate delivery)."""
+        if message_id in self._ids:
+            self._ids.move_to_end(message_id)
+            self.duplicates += 1
+            return False
+        self._ids[message_id] = None
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+    def release(self, message_id: str):
+        # Processing failed: the queue retry must not be mistaken for a duplicate
+        self._ids.pop(message_id, None)
+
+    async def warm(self):
+        """Seeds the set with the most recent stored ids so a restart does not reopen the window."""
+        try:
+            async with SessionLocal() as db:
+                result = await db.execute(
+                    select(Mensagem.id_externo)
+                    .where(Mensagem.id_externo.is_not(None))
+                    .order_by(Mensagem.id_mensagem.desc())
+                    .limit(self.max_size)
+                )
+                ids = result.scalars().all()
+        except SQLAlchemyError as e:
+            # Schema not migrated yet: start cold, the unique index still dedups once init_tables.py has run
+            logger.warning(f"⚠️ Could not load WAHA message ids for deduplication (run init_tables.py?), starting empty: {getattr(e, 'orig', None) or e}")
+            return
+        for message_id in reversed(ids): # oldest first, so the newest are evicted last
+            self._ids[message_id] = None
+        logger.info(f"♻️ Loaded {len(ids)} recent WAHA message ids for deduplication")
+
+    def stats(self) -> dict:
+        return {"size": len(self._ids), "max_size": self.max_size, "duplicates": self.duplicates}
+
+
+seen_messages = SeenMessages(settings.WEBHOOK_DEDUP_SIZE)
@@ -1,36 +1,236 @@
-import google.generativeai as genai
-from openai import AsyncOpenAI
-from anthropic import AsyncAnthropic
+from functools import lru_cache
+import hashlib
+import time
+from typing import AsyncIterator, Optional, Union
 from core.config import settings
+from services.config_cache import agent_config_cache
+from services.provider_limits import provider_slot
+from services.provider_router import provider_router
+from services.llm_cache import llm_cache, make_key
+from services.media import DownloadedMedia
+from services.transcript import estimate_tokens
+from core.metrics import llm_request_seconds, llm_tokens, llm_cost, llm_cache_hits
+
+# Provider SDKs are imported on first use: together they add seconds and ~100 MB
+# to every worker (and spreadsheet subprocess) that never calls that provider.
+
+@lru_cache(maxsize=1)
+def _genai():
+    import google.generativeai as genai
+    if settings.GEMINI_API_KEY:
+        genai.configure(api_key=settings.GEMINI_API_KEY)
+    return genai
+
+@lru_cache(maxsize=32)
+def _gemini_model(model_name: str, generation_params: tuple = ()):
+    """Cached GenerativeModel per (model, generation params); params are a sorted items tuple."""
+    return _genai().GenerativeModel(model_name, generation_config=dict(generation_params) or None)
+
+def _gemini_generation(params: Optional[dict], json_mode: bool = False) -> tuple:
+    generation = ()
+    if params:
+        generation = (("max_output_tokens", params["max_tokens"]), ("temperature", params["temperature"]))
+    if json_mode:
+        generation += (("response_mime_type", "application/json"),)
+    return generation
+
+def _cache_params(params: Optional[dict], json_mode: bool) -> Optional[dict]:
+    # JSON mode changes the completion, so it is part of the cache key (plain calls keep their keys)
+    return {**(params or {}), "json_mode": True} if json_mode else params
+
+# Anthropic has no JSON mode: prefilling the assistant turn with "{" makes it answer with the object
+ANTHROPIC_JSON_PREFILL = "{"
+
+def _gemini_usage(response) -> tuple:
+    metadata = getattr(response, "usage_metadata", None)
+    if not metadata:
+        return None, None
+    return metadata.prompt_token_count, metadata.candidates_token_count
+
+def _call_cost(system_prompt: Optional[str], prompt: str, params: Optional[dict]) -> int:
+    # Scheduler / TPM cost: what providers count against rate limits (input + max output)
+    return estimate_tokens((system_prompt or "") + prompt) + (params["max_tokens"] if params else 0)
+
+def _record_usage(provider: str, model_name: str, usage: tuple, prompt: str, completion: str):
+    """Token and cost counters; falls back to the local estimate when the provider reports no usage."""
+    prompt_tokens, completion_tokens = usage
+    if prompt_tokens is None:
+        prompt_tokens = estimate_tokens(prompt)
+    if completion_tokens is None:
+        completion_tokens = estimate_tokens(completion or "")
+    llm_tokens.inc(prompt_tokens, provider=provider, model=model_name, kind="prompt")
+    llm_tokens.inc(completion_tokens, provider=provider, model=model_name, kind="completion")
+    price = settings.LLM_PRICING.get(model_name)
+    if price:
+        llm_cost.inc((prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000, provider=provider, model=model_name)
+
+def _anthropic_messages(prompt: str, json_mode: bool) -> list:
+    messages = [{"role": "user", "content": prompt}]
+    if json_mode:
+        messages.append({"role": "assistant", "content": ANTHROPIC_JSON_PREFILL})
+    return messages
+
+def _openai_format(json_mode: bool) -> dict:
+    return {"response_format": {"type": "json_object"}} if json_mode else {}
 
 class LLMService:
     def __init__(self):
-        # Initialize Gemini
-        if settings.GEMINI_API_KEY:
-            genai.configure(api_key=settings.GEMINI_API_KEY)
-            self.gemini_model = genai.GenerativeModel(settings.MODEL_REPORT)
-        
-        # Initialize OpenAI
-        self.openai_client = None
-        if settings.OPENAI_API_KEY:
-            self.openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-            
-        # Initialize Anthropic
-        self.anthropic_client = None
-        if settings.ANTHROPIC_API_KEY:
-            self.anthropic_client = AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY)
+        # Clients are created on first use (see the properties below)
+        self._openai_client = None
+        self._anthropic_client = None
+
+    @property
+    def openai_client(self):
+        if self._openai_client is None and settings.OPENAI_API_KEY:
+            from openai import AsyncOpenAI
+            self._openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_BASE_URL or None)
+        return self._openai_client
+
+    @property
+    def anthropic_client(self):
+        if self._anthropic_client is None and settings.ANTHROPIC_API_KEY:
+            from anthropic import AsyncAnthropic
+            self._anthropic_client = AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY, base_url=settings.ANTHROPIC_BASE_URL or None)
+        return self._anthropic_client
 
     async def _get_config(self, db, provider: str):
-        from models.db_models import AgentConfig
-        from sqlalchemy import select
-        if not db: return None
         try:
-            result = db.execute(select(AgentConfig).where(AgentConfig.provider == provider))
-            return result.scalar_one_or_none()
+            return await agent_config_cache.get(db, provider)
         except:
             return None
 
-    async def generate_report(self, db, prompt: str) -> str:
+    def _analysis_target(self, config, provider: str):
+        """
+        Resolves (provider, model, system_prompt) actually used for an analysis call,
+        or (None, None, None) when no provider is configured.
+        """
+        if provider == "gemini":
+            # Use Gemini 3.0 Pro/Flash
+            return "gemini", config.model if config else settings.MODEL_REPORT, None
+        if provider == "anthropic" and settings.ANTHROPIC_API_KEY:
+            return "anthropic", config.model if config else settings.MODEL_ANALYSIS_B, None
+        if settings.OPENAI_API_KEY: # Default to OpenAI
+            system_prompt = config.system_prompt if config and config.system_prompt else "You are an expert analyst."
+            return "openai", config.model if config else settings.MODEL_ANALYSIS_A, system_prompt
+        return None, None, None
+
+    async def _complete(self, provider: str, model_name: str, params: Optional[dict], system_prompt: Optional[str], prompt: str, json_mode: bool = False) -> str:
+        cache_key = make_key(provider, model_name, _cache_params(params, json_mode), system_prompt, prompt)
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            llm_cache_hits.inc(provider=provider)
+            return cached
+
+        async with provider_slot(provider, _call_cost(system_prompt, prompt, params)):
+            started = time.perf_counter()
+            try:
+                if provider == "gemini":
+                    model = _gemini_model(model_name, _gemini_generation(params, json_mode))
+                    response = await model.generate_content_async(prompt)
+                    text = response.text
+                    usage = _gemini_usage(response)
+
+                elif provider == "anthropic":
+                    message = await self.anthropic_client.messages.create(
+                        model=model_name, 
+                        max_tokens=params["max_tokens"],
+                        temperature=params["temperature"],
+                        messages=_anthropic_messages(prompt, json_mode)
+                    )
+                    text = (ANTHROPIC_JSON_PREFILL if json_mode else "") + message.content[0].text
+                    usage = (message.usage.input_tokens, message.usage.output_tokens) if getattr(message, "usage", None) else (None, None)
+
+                else:
+                    response = await self.openai_client.chat.completions.create(
+                        model=model_name, 
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": prompt}
+                        ],
+                        temperature=params["temperature"],
+                        max_tokens=params["max_tokens"],
+                        **_openai_format(json_mode)
+                    )
+                    text = response.choices[0].message.content
+                    usage = (response.usage.prompt_tokens, response.usage.completion_tokens) if response.usage else (None, None)
+            except Exception:
+                llm_request_seconds.observe(time.perf_counter() - started, provider=provider, model=model_name, outcome="error")
+                raise
+            llm_request_seconds.observe(time.perf_counter() - started, provider=provider, model=model_name, outcome="ok")
+
+        _record_usage(provider, model_name, usage, (system_prompt or "") + prompt, text)
+        await llm_cache.put(cache_key, text, provider, model_name)
+        return text
+
+    async def _stream(self, provider: str, model_name: str, params: Optional[dict], system_prompt: Optional[str], prompt: str, json_mode: bool = False) -> AsyncIterator[str]:
+        """Streaming twin of _complete; a cache hit is replayed as a single chunk."""
+        cache_key = make_key(provider, model_name, _cache_params(params, json_mode), system_prompt, prompt)
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            llm_cache_hits.inc(provider=provider)
+            yield cached
+            return
+
+        chunks = []
+        usage = (None, None)
+        async with provider_slot(provider, _call_cost(system_prompt, prompt, params)):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                if provider == "gemini":
+                    model = _gemini_model(model_name, _gemini_generation(params, json_mode))
+                    response = await model.generate_content_async(prompt, stream=True)
+                    async for chunk in response:
+                        if chunk.text:
+                            chunks.append(chunk.text)
+                            yield chunk.text
+                    usage = _gemini_usage(response)
+
+                elif provider == "anthropic":
+                    async with self.anthropic_client.messages.stream(
+                        model=model_name,
+                        max_tokens=params["max_tokens"],
+                        temperature=params["temperature"],
+                        messages=_anthropic_messages(prompt, json_mode)
+                    ) as stream:
+                        if json_mode:
+                            chunks.append(ANTHROPIC_JSON_PREFILL)
+                            yield ANTHROPIC_JSON_PREFILL
+                        async for text in stream.text_stream:
+                            chunks.append(text)
+                            yield text
+                        final = await stream.get_final_message()
+                        usage = (final.usage.input_tokens, final.usage.output_tokens)
+
+                else:
+                    stream = await self.openai_client.chat.completions.create(
+                        model=model_name,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": prompt}
+                        ],
+                        temperature=params["temperature"],
+                        max_tokens=params["max_tokens"],
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        **_openai_format(json_mode)
+                    )
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            chunks.append(delta)
+                            yield delta
+                        if getattr(chunk, "usage", None): # last chunk, no choices
+                            usage = (chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                outcome = "ok"
+            finally:
+                llm_request_seconds.observe(time.perf_counter() - started, provider=provider, model=model_name, outcome=outcome)
+
+        text = "".join(chunks)
+        _record_usage(provider, model_name, usage, (system_prompt or "") + prompt, text)
+        await llm_cache.put(cache_key, text, provider, model_name)
+
+    async def generate_report(self, db, prompt: str, json_mode: bool = False) -> str:
         """
         Generates strategic reports using Gemini 3.0
         """
@@ -38,88 +238,123 @@ class LLMService:
             # Dynamic Config
             config = await self._get_config(db, "gemini")
             model_name = config.model if config else settings.MODEL_REPORT
-            
-            # Re-configure if model changed (or just use the name if generic)
-            # For Gemini, we might need a new model instance if the name changes
-            model = genai.GenerativeModel(model_name)
-            
-            response = model.generate_content(prompt)
-            return response.text
+            return await self._complete("gemini", model_name, None, None, prompt, json_mode and settings.LLM_JSON_MODE)
         except Exception as e:
             print(f"Error generating report with Gemini: {e}")
             return "Erro ao gerar relatório com Gemini."
 
-    async def analyze_conversation(self, db, prompt: str, provider: str = "openai") -> str:
+    async def stream_report(self, db, prompt: str, json_mode: bool = False) -> AsyncIterator[str]:
         """
-        Analyzes conversations using OpenAI (GPT-5.2) or Anthropic (Claude 4.5)
+        Streams a strategic report from Gemini chunk by chunk
         """
         try:
-            config = await self._get_config(db, provider)
-            
-            # Parameter overrides
-            temp = config.temperature if config else 0.7
-            max_tok = config.max_tokens if config else 2000
-            
-            if provider == "gemini":
-                # Use Gemini 3.0 Pro/Flash
-                model_name = config.model if config else settings.MODEL_REPORT
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content(prompt, generation_config={"temperature": temp, "max_output_tokens": max_tok})
-                return response.text
-
-            elif provider == "anthropic" and self.anthropic_client:
-                model_name = config.model if config else settings.MODEL_ANALYSIS_B
-                message = await self.anthropic_client.messages.create(
-                    model=model_name, 
-                    max_tokens=max_tok,
-                    temperature=temp,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-                return message.content[0].text
-
-            elif self.openai_client: # Default to OpenAI
-                model_name = config.model if config else settings.MODEL_ANALYSIS_A
-                
-                msgs = [{"role": "user", "content": prompt}]
-                if config and config.system_prompt:
-                     msgs.insert(0, {"role": "system", "content": config.system_prompt})
-                else:
-                     msgs.insert(0, {"role": "system", "content": "You are an expert analyst."})
-
-                response = await self.openai_client.chat.completions.create(
-                    model=model_name, 
-                    messages=msgs,
-                    temperature=temp,
-                    max_tokens=max_tok
-                )
-                return response.choices[0].message.content
-                
-            else:
+            config = await self._get_config(db, "gemini")
+            model_name = config.model if config else settings.MODEL_REPORT
+            async for chunk in self._stream("gemini", model_name, None, None, prompt, json_mode and settings.LLM_JSON_MODE):
+                yield chunk
+        except Exception as e:
+            print(f"Error streaming report with Gemini: {e}")
+            yield "Erro ao gerar relatório com Gemini."
+
+    def _available_providers(self) -> list:
+        available = []
+        if settings.OPENAI_API_KEY:
+            available.append("openai")
+        if settings.ANTHROPIC_API_KEY:
+            available.append("anthropic")
+        if settings.GEMINI_API_KEY:
+            available.append("gemini")
+        return available
+
+    async def _analysis_call(self, db, provider: str):
+        """Resolves config for one provider; returns (provider, model, params, system_prompt)."""
+        config = await self._get_config(db, provider)
+        
+        # Parameter overrides
+        params = {
+            "temperature": config.temperature if config else 0.7,
+            "max_tokens": config.max_tokens if config else 2000,
+        }
+        
+        target, model_name, system_prompt = self._analysis_target(config, provider)
+        return target, model_name, params, system_prompt
+
+    async def analyze_conversation(self, db, prompt: str, provider: str = "openai", json_mode: bool = False) -> str:
+        """
+        Analyzes conversations using OpenAI (GPT-5.2) or Anthropic (Claude 4.5),
+        failing over to the other configured providers (see provider_router).
+        json_mode asks the provider for a bare JSON object (LLM_JSON_MODE)
+        """
+        async def call(candidate: str) -> str:
+            target, model_name, params, system_prompt = await self._analysis_call(db, candidate)
+            return await self._complete(target, model_name, params, system_prompt, prompt, json_mode and settings.LLM_JSON_MODE)
+
+        try:
+            if not self._available_providers():
                 return "Nenhum provedor de análise configurado."
+            return await provider_router.run(provider, self._available_providers(), call)
 
         except Exception as e:
             print(f"Error analyzing with {provider}: {e}")
             return f"Erro na análise: {str(e)}"
 
-    async def analyze_media(self, db, media_bytes: bytes, mime_type: str, prompt: str = "Analise este arquivo.") -> str:
+    async def stream_analysis(self, db, prompt: str, provider: str = "openai", json_mode: bool = False) -> AsyncIterator[str]:
         """
-        Analyzes generic media (Image, Audio, PDF) using Gemini Flash
+        Streams a conversation analysis from the selected provider chunk by chunk
+        (fails over to another provider only before the first chunk)
+        """
+        async def open_stream(candidate: str) -> AsyncIterator[str]:
+            target, model_name, params, system_prompt = await self._analysis_call(db, candidate)
+            async for chunk in self._stream(target, model_name, params, system_prompt, prompt, json_mode and settings.LLM_JSON_MODE):
+                yield chunk
+
+        try:
+            if not self._available_providers():
+                yield "Nenhum provedor de análise configurado."
+                return
+            async for chunk in provider_router.stream(provider, self._available_providers(), open_stream):
+                yield chunk
+
+        except Exception as e:
+            print(f"Error streaming analysis with {provider}: {e}")
+            yield f"Erro na análise: {str(e)}"
+
+    async def analyze_media(self, db, media: Union[bytes, DownloadedMedia], mime_type: str, prompt: str = "Analise este arquivo.") -> str:
+        """
+        Analyzes generic media (Image, Audio, PDF) using Gemini Flash.
+        Results are cached by content hash + prompt, so forwarded media is analyzed once;
+        a DownloadedMedia is only read into memory on a cache miss.
         """
         try:
             config = await self._get_config(db, "gemini")
             model_name = config.model if config else settings.MODEL_MEDIA
+
+            content_hash = media.sha256 if isinstance(media, DownloadedMedia) else hashlib.sha256(media).hexdigest()
+            cache_key = make_key("gemini", model_name, {"media_sha256": content_hash, "mime_type": mime_type}, None, prompt)
+            cached = await llm_cache.get(cache_key)
+            if cached is not None:
+                llm_cache_hits.inc(provider="gemini")
+                return cached
             
-            model = genai.GenerativeModel(model_name)
+            model = _gemini_model(model_name)
+            media_bytes = media.read() if isinstance(media, DownloadedMedia) else media
             
-            response = model.generate_content([
-                prompt,
-                {
-                    "mime_type": mime_type,
-                    "data": media_bytes
-                }
-            ])
+            async with provider_slot("gemini", _call_cost(None, prompt, None)):
+                started = time.perf_counter()
+                try:
+                    response = await model.generate_content_async([
+                        prompt,
+                        {
+                            "mime_type": mime_type,
+                            "data": media_bytes
+                        }
+                    ])
+                except Exception:
+                    llm_request_seconds.observe(time.perf_counter() - started, provider="gemini", model=model_name, outcome="error")
+                    raise
+                llm_request_seconds.observe(time.perf_counter() - started, provider="gemini", model=model_name, outcome="ok")
+            _record_usage("gemini", model_name, _gemini_usage(response), prompt, response.text)
+            await llm_cache.put(cache_key, response.text, "gemini", model_name)
             return response.text
         except Exception as e:
             print(f"Error analyzing media with Gemini: {e}")
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from sqlalchemy import select, delete, update, func
+
+from core.config import settings
+from core.database import SessionLocal
+from models.db_models import LLMCacheEntry
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(provider: str, model: str, params: Optional[Dict[str, Any]], system_prompt: Optional[str], prompt: str) -> str:
+    """SHA-256 over everything that changes the completion."""
+    material = json.dumps(
+        [provider, model, params or {}, system_prompt or "", prompt],
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Two-tier cache of successful LLM completions.
+    Tier 1 is a per-process LRU, tier 2 the llm_cache table shared by all workers.
+    Both tiers honour LLM_CACHE_TTL_SECONDS; the table is pruned to LLM_CACHE_MAX_ROWS.
+    """
+
+    def __init__(self):
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._writes_since_prune = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        if not settings.LLM_CACHE_ENABLED:
+            return None
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+            del self._memory[key]
+
+        try:
+            async with SessionLocal() as db:
+                result = await db.execute(
+                    select(LLMCacheEntry.response, LLMCacheEntry.expires_at)
+                    .where(LLMCacheEntry.key == key)
+                )
+                row = result.first()
+                if row is not None and _aware(row.expires_at) > datetime.now(timezone.utc):
+                    await db.execute(
+                        update(LLMCacheEntry)
+                        .where(LLMCacheEntry.key == key)
+                        .values(hits=LLMCacheEntry.hits + 1)
+                    )
+                    await db.commit()
+                    remaining = (_aware(row.expires_at) - datetime.now(timezone.utc)).total_seconds()
+                    self._remember(key, row.response, remaining)
+                    self.db_hits += 1
+                    return row.response
+        except Exception as e:
+            logger.warning(f"⚠️ LLM cache lookup failed: {e}")
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: str, provider: str, model: str):
+        if not settings.LLM_CACHE_ENABLED or not value:
+            return
+        self._remember(key, value, settings.LLM_CACHE_TTL_SECONDS)
+
+        now = datetime.now(timezone.utc)
+        try:
+            async with SessionLocal() as db:
+                await db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.key == key))
+                db.add(LLMCacheEntry(
+                    key=key,
+                    provider=provider,
+                    model=model,
+                    response=value,
+                    created_at=now,
+                    expires_at=now + timedelta(seconds=settings.LLM_CACHE_TTL_SECONDS),
+                    hits=0,
+                ))
+                await db.commit()
+            self.writes += 1
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= settings.LLM_CACHE_PRUNE_EVERY:
+                self._writes_since_prune = 0
+                await self.prune()
+        except Exception as e:
+            logger.warning(f"⚠️ LLM cache write failed: {e}")
+
+    async def prune(self) -> int:
+        """Drops expired rows, then the oldest rows beyond LLM_CACHE_MAX_ROWS."""
+        async with SessionLocal() as db:
+            expired = await db.execute(
+                delete(LLMCacheEntry).where(LLMCacheEntry.expires_at <= datetime.now(timezone.utc))
+            )
+            removed = expired.rowcount or 0
+            total = (await db.execute(select(func.count()).select_from(LLMCacheEntry))).scalar_one()
+            overflow = total - settings.LLM_CACHE_MAX_ROWS
+            if overflow > 0:
+                oldest = select(LLMCacheEntry.key).order_by(LLMCacheEntry.created_at).limit(overflow)
+                evicted = await db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.key.in_(oldest)))
+                removed += evicted.rowcount or 0
+            await db.commit()
+        return removed
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "enabled": settings.LLM_CACHE_ENABLED,
+            "memory_size": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_ratio": round((self.memory_hits + self.db_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+    def _remember(self, key: str, value: str, ttl_seconds: float):
+        self._memory[key] = (value, time.monotonic() + ttl_seconds)
+        self._memory.move_to_end(key)
+        while len(self._memory) > settings.LLM_CACHE_MEMORY_SIZE:
+            self._memory.popitem(last=False)
+
+
+def _aware(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; everything we store is UTC
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+llm_cache = LLMResponseCache()
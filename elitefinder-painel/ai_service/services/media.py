@@ -0,0 +1,68 @@
+import hashlib
+import logging
+import tempfile
+from dataclasses import dataclass
+
+import httpx
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MediaTooLargeError(Exception):
+    """Raised when a download exceeds MEDIA_MAX_BYTES."""
+
+
+@dataclass
+class DownloadedMedia:
+    """
+    Media spooled to memory (small files) or a temp file (large ones),
+    with its SHA-256 computed while streaming.
+    """
+    buffer: tempfile.SpooledTemporaryFile
+    size: int
+    sha256: str
+    mime_type: str
+
+    def read(self) -> bytes:
+        self.buffer.seek(0)
+        return self.buffer.read()
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def download_media(client: httpx.AsyncClient, url: str, mime_type: str, max_bytes: int = None) -> DownloadedMedia:
+    """
+    Streams `url` into a spooled buffer, hashing on the fly and aborting
+    as soon as the body (or its Content-Length) passes max_bytes.
+    """
+    max_bytes = max_bytes or settings.MEDIA_MAX_BYTES
+    buffer = tempfile.SpooledTemporaryFile(max_size=settings.MEDIA_SPOOL_MEMORY_BYTES)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with client.stream("GET", url, timeout=settings.MEDIA_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            declared = response.headers.get("content-length")
+            if declared and declared.isdigit() and int(declared) > max_bytes:
+                raise MediaTooLargeError(f"Media declares {declared} bytes (limit {max_bytes})")
+
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > max_bytes:
+                    raise MediaTooLargeError(f"Media exceeded {max_bytes} bytes while downloading")
+                hasher.update(chunk)
+                buffer.write(chunk)
+    except BaseException:
+        buffer.close()
+        raise
+
+    return DownloadedMedia(buffer=buffer, size=size, sha256=hasher.hexdigest(), mime_type=mime_type)
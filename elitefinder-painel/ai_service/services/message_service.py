@@ -1,63 +1,308 @@
-from sqlalchemy.orm import Session
+import asyncio
+from dataclasses import dataclass, field
+from typing import List, NamedTuple, Optional
+from sqlalchemy import select, insert, update
+from sqlalchemy.dialects import postgresql, sqlite
 from models.db_models import Atendimento, Mensagem
-from core.database import get_db
-from datetime import datetime
+from core.config import settings
+from core.database import SessionLocal, engine
+from core.metrics import registry, stage, message_batch_size
+from services.ticket_cache import ticket_cache
+from services.rollups import record_messages
+from datetime import datetime, timezone
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Direct-chat JID suffixes; groups (@g.us), status@broadcast, newsletters and @lid ids are not phones
+CONTACT_JID_SUFFIXES = ("@c.us", "@s.whatsapp.net")
+PHONE_MAX_LENGTH = Atendimento.telefone_cliente.type.length
+
+def normalize_phone(jid: str) -> Optional[str]:
+    """Phone number of a direct-chat WhatsApp JID, or None for anything that cannot be a ticket's phone."""
+    for suffix in CONTACT_JID_SUFFIXES:
+        if jid.endswith(suffix):
+            phone = jid[:-len(suffix)]
+            return phone if phone and len(phone) <= PHONE_MAX_LENGTH else None
+    return jid if "@" not in jid and len(jid) <= PHONE_MAX_LENGTH else None
+
+class SavedMessage(NamedTuple):
+    id_mensagem: int
+    id_atendimento: int
+    duplicate: bool = False # external_id was already stored; these are the existing row's ids
+
+@dataclass
+class _PendingMessage:
+    phone: str
+    text: str
+    sender_type: str
+    contact_name: str
+    sent_at: datetime
+    future: asyncio.Future = field(repr=False)
+    external_id: Optional[str] = None
+
 class MessageService:
+    """
+    Group-commit writer for WhatsApp messages.
+    Messages are buffered for MESSAGE_BATCH_WINDOW_MS (or until MESSAGE_BATCH_MAX_SIZE),
+    then tickets are resolved for the whole batch in one query and every row is
+    written in a single transaction. Each caller awaits its own future; a failed
+    batch is retried one message at a time so only the bad row's caller fails.
+    """
+
     def __init__(self):
-        pass
+        self._pending: List[_PendingMessage] = []
+        self._flush_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._inflight = set()
 
-    async def save_message(self, db: Session, phone_number: str, message_text: str, sender_type: str, contact_name: str):
+    async def save_message(self, phone_number: str, message_text: str, sender_type: str, contact_name: str, external_id: str = None) -> Optional[SavedMessage]:
         """
         Saves a message to the database, creating a Ticket (Atendimento) if needed.
+        Returns the saved IDs, or None if the write failed. A message whose
+        external_id (WAHA id) is already stored is not inserted again.
+        Raises ValueError for a JID that is not a direct chat (see normalize_phone).
         """
+        # 1. Normalize Phone Number (rejected here so a bad row never joins a batch)
+        normalized_phone = normalize_phone(phone_number)
+        if normalized_phone is None:
+            raise ValueError(f"Unsupported WhatsApp JID {phone_number!r}")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(_PendingMessage(
+            phone=normalized_phone,
+            text=message_text,
+            sender_type=sender_type, # 'cliente' or 'atendente'
+            contact_name=contact_name,
+            sent_at=datetime.now(timezone.utc),
+            future=future,
+            external_id=external_id,
+        ))
+
+        if len(self._pending) >= settings.MESSAGE_BATCH_MAX_SIZE:
+            self._spawn(self.flush())
+        elif self._timer is None:
+            self._timer = self._spawn(self._flush_after_window())
+
+        try:
+            with stage("message.save"): # batch window + group commit, as seen by the caller
+                saved = await future
+        except Exception as e:
+            logger.error(f"❌ Error saving message to DB: {e}")
+            return None
+
+        if saved.duplicate:
+            logger.info(f"♻️ Message {external_id} already stored as {saved.id_mensagem}")
+        else:
+            logger.info(f"💾 Message saved. Ticket ID: {saved.id_atendimento} | Msg ID: {saved.id_mensagem}")
+        return saved
+
+    async def flush(self):
+        """Writes every buffered message. Also called on shutdown to drain the buffer."""
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            message_batch_size.observe(len(batch))
+            try:
+                with stage("message.batch_write"):
+                    results = await self._write_batch(batch)
+            except Exception as e:
+                # A cached ticket may have been deleted/closed underneath us; re-resolve on retry
+                for item in batch:
+                    ticket_cache.invalidate(item.phone)
+                if len(batch) == 1:
+                    logger.error(f"❌ Error writing message: {e}", exc_info=True)
+                    _resolve(batch[0], exception=e)
+                    return
+                # One bad row must not fail (and re-queue) every message it was batched with
+                logger.warning(f"⚠️ Batch of {len(batch)} messages failed ({e}); retrying them one by one")
+                await self._write_each(batch)
+                return
+            for item, saved in zip(batch, results):
+                _resolve(item, saved)
+
+    async def _write_each(self, batch: List[_PendingMessage]):
+        for item in batch:
+            try:
+                saved = (await self._write_batch([item]))[0]
+            except Exception as e:
+                ticket_cache.invalidate(item.phone)
+                logger.error(f"❌ Error writing message {item.external_id or ''} for {item.phone}: {e}", exc_info=True)
+                _resolve(item, exception=e)
+            else:
+                _resolve(item, saved)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        # Keep a reference so pending flushes are not garbage collected mid-write
+        task = asyncio.create_task(coro)
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        return task
+
+    async def _flush_after_window(self):
         try:
-            # 1. Normalize Phone Number
-            normalized_phone = phone_number.replace("@c.us", "")
-
-            # 2. Find Active Ticket (Status != 'fechado')
-            ticket = db.query(Atendimento).filter(
-                Atendimento.telefone_cliente == normalized_phone,
-                Atendimento.status_atendimento != 'fechado'
-            ).order_by(Atendimento.data_hora_inicio.desc()).first()
-
-            # 3. Create Ticket if None exists
-            if not ticket:
-                logger.info(f"🆕 Creating new ticket for {contact_name} ({normalized_phone})")
-                ticket = Atendimento(
-                    data_hora_inicio=datetime.utcnow(),
-                    canal_origem="whatsapp",
-                    id_cliente=1, # Default/Placeholder
-                    id_atendente=1, # Default/Bot
-                    status_atendimento="aberto",
-                    nome_cliente=contact_name,
-                    telefone_cliente=normalized_phone
+            await asyncio.sleep(settings.MESSAGE_BATCH_WINDOW_MS / 1000)
+        finally:
+            self._timer = None
+        await self.flush()
+        # Messages that arrived while we were writing get their own window
+        if self._pending and self._timer is None:
+            self._timer = self._spawn(self._flush_after_window())
+
+    async def _write_batch(self, batch: List[_PendingMessage]) -> List[SavedMessage]:
+        phones = {item.phone for item in batch}
+        tickets = ticket_cache.get_many(phones)
+        uncached = phones - tickets.keys()
+
+        async with SessionLocal() as db:
+            # 2. Find Active Tickets (Status != 'fechado') for cache misses in one query
+            if uncached:
+                with stage("message.ticket_lookup"):
+                    result = await db.execute(
+                        select(Atendimento.telefone_cliente, Atendimento.id_atendimento)
+                        .where(
+                            Atendimento.telefone_cliente.in_(uncached),
+                            Atendimento.status_atendimento != 'fechado'
+                        )
+                        .order_by(Atendimento.telefone_cliente, Atendimento.data_hora_inicio.desc())
+                    )
+                for phone, ticket_id in result.all():
+                    tickets.setdefault(phone, ticket_id) # first row per phone is the latest
+
+            # 3. Create Tickets for phones without one
+            missing = {}
+            for item in batch:
+                if item.phone not in tickets and item.phone not in missing:
+                    logger.info(f"🆕 Creating new ticket for {item.contact_name} ({item.phone})")
+                    missing[item.phone] = {
+                        "data_hora_inicio": item.sent_at,
+                        "canal_origem": "whatsapp",
+                        "id_cliente": 1, # Default/Placeholder
+                        "id_atendente": 1, # Default/Bot
+                        "status_atendimento": "aberto",
+                        "nome_cliente": item.contact_name,
+                        "telefone_cliente": item.phone,
+                    }
+            if missing:
+                with stage("message.ticket_create"):
+                    created = await db.execute(
+                        insert(Atendimento).returning(
+                            Atendimento.telefone_cliente, Atendimento.id_atendimento, sort_by_parameter_order=True
+                        ),
+                        list(missing.values()),
+                    )
+                tickets.update({phone: ticket_id for phone, ticket_id in created.all()})
+
+            # 4. Save Messages (None for a WAHA id that is already stored)
+            with stage("message.insert"):
+                message_ids = await self._insert_messages(db, [
+                    {
+                        "id_atendimento": tickets[item.phone],
+                        "conteudo_texto": item.text,
+                        "data_hora_envio": item.sent_at,
+                        "remetente_tipo": item.sender_type,
+                        "tipo_analise": None,
+                        "id_externo": item.external_id,
+                    }
+                    for item in batch
+                ])
+
+            existing = {}
+            duplicates = {item.external_id for item, message_id in zip(batch, message_ids) if message_id is None}
+            if duplicates:
+                result = await db.execute(
+                    select(Mensagem.id_externo, Mensagem.id_mensagem, Mensagem.id_atendimento)
+                    .where(Mensagem.id_externo.in_(duplicates))
                 )
-                db.add(ticket)
-                db.commit()
-                db.refresh(ticket)
-            
-            # 4. Save Message
-            new_message = Mensagem(
-                id_atendimento=ticket.id_atendimento,
-                conteudo_texto=message_text,
-                data_hora_envio=datetime.utcnow(),
-                remetente_tipo=sender_type, # 'cliente' or 'atendente'
-                tipo_analise=None
+                existing = {external_id: SavedMessage(message_id, ticket_id, duplicate=True) for external_id, message_id, ticket_id in result.all()}
+
+            # 5. Rollups ride the same transaction; a failure there must not drop messages
+            try:
+                with stage("message.rollups"):
+                    async with db.begin_nested():
+                        await record_messages(
+                            db,
+                            [
+                                (message_id, tickets[item.phone], item.sender_type, item.sent_at)
+                                for item, message_id in zip(batch, message_ids) if message_id is not None
+                            ],
+                            new_tickets=[tickets[phone] for phone in missing],
+                        )
+            except Exception as e:
+                logger.error(f"⚠️ Rollup update failed for batch of {len(batch)} messages (use /admin/rollups/rebuild): {e}")
+            with stage("message.commit"):
+                await db.commit()
+
+        # Only cache after commit so rolled-back tickets never leak into the cache
+        for phone in phones:
+            ticket_cache.put(phone, tickets[phone])
+
+        return [
+            SavedMessage(message_id, tickets[item.phone]) if message_id is not None else existing[item.external_id]
+            for item, message_id in zip(batch, message_ids)
+        ]
+
+    async def _insert_messages(self, db, rows: List[dict]) -> List[Optional[int]]:
+        """
+        Inserts mensagem rows and returns their ids in order. Rows with an
+        id_externo go through ON CONFLICT DO NOTHING on uq_mensagem_id_externo;
+        those already stored (or repeated within the batch) come back as None.
+        """
+        ids: List[Optional[int]] = [None] * len(rows)
+        plain = [i for i, row in enumerate(rows) if row["id_externo"] is None]
+        keyed = [i for i, row in enumerate(rows) if row["id_externo"] is not None]
+
+        if plain:
+            inserted = await db.execute(
+                insert(Mensagem).returning(Mensagem.id_mensagem, sort_by_parameter_order=True),
+                [rows[i] for i in plain],
             )
-            db.add(new_message)
-            db.commit()
-            db.refresh(new_message)
-            
-            logger.info(f"💾 Message saved. Ticket ID: {ticket.id_atendimento} | Msg ID: {new_message.id_mensagem}")
-            return new_message
+            for i, message_id in zip(plain, inserted.scalars().all()):
+                ids[i] = message_id
 
-        except Exception as e:
-            logger.error(f"❌ Error saving message to DB: {e}", exc_info=True)
-            db.rollback()
-            return None
+        if keyed:
+            dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+            inserted = await db.execute(
+                dialect.insert(Mensagem)
+                .on_conflict_do_nothing(index_elements=[Mensagem.id_externo])
+                .returning(Mensagem.id_externo, Mensagem.id_mensagem),
+                [rows[i] for i in keyed],
+            )
+            by_external_id = dict(inserted.all())
+            for i in keyed:
+                # pop: a second copy in the same batch is a duplicate of the first
+                ids[i] = by_external_id.pop(rows[i]["id_externo"], None)
+        return ids
+
+    async def close_ticket(self, ticket_id: int) -> bool:
+        """Marks a ticket as 'fechado' and drops it from the phone cache."""
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(Atendimento)
+                .where(Atendimento.id_atendimento == ticket_id)
+                .values(status_atendimento="fechado", data_hora_fim=datetime.now(timezone.utc))
+                .returning(Atendimento.telefone_cliente)
+            )
+            row = result.first()
+            await db.commit()
+        if row is None:
+            return False
+        if row.telefone_cliente:
+            ticket_cache.invalidate(row.telefone_cliente)
+        else:
+            ticket_cache.invalidate_ticket(ticket_id)
+        return True
+
+def _resolve(item: _PendingMessage, saved: SavedMessage = None, exception: Exception = None):
+    if item.future.done(): # caller cancelled
+        return
+    if exception is not None:
+        item.future.set_exception(exception)
+    else:
+        item.future.set_result(saved)
 
 message_service = MessageService()
+
+_pending_gauge = registry.gauge("aiservice_message_buffer", "Messages waiting for the next group commit")
+registry.add_collector(lambda: _pending_gauge.set(len(message_service._pending)))
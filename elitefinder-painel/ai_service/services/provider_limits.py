@@ -0,0 +1,244 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from core.config import settings
+from core.metrics import registry
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per `per` seconds, bursting up to `capacity`."""
+
+    def __init__(self, rate: float, per: float = 60.0, capacity: float = None):
+        self.rate = rate
+        self.per = per
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate / self.per)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        amount = min(amount, self.capacity) # a request larger than the burst would wait forever
+        # The lock keeps waiters FIFO so a large request is not starved by small ones
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) * self.per / self.rate)
+
+
+# --- Who is asking: tenant and priority of the current LLM work --------------
+
+PRIORITIES = {"interactive": 0, "background": 1, "batch": 2}
+
+
+@dataclass(frozen=True)
+class LLMWork:
+    tenant_id: int = 0 # 0 = no tenant
+    priority: str = "interactive"
+
+
+_current_work: ContextVar[LLMWork] = ContextVar("llm_work", default=LLMWork())
+
+
+def set_llm_work(tenant_id: Optional[int] = None, priority: str = "interactive"):
+    """Tags LLM calls made from the current context (and tasks it spawns); returns the reset token."""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown LLM priority {priority!r}")
+    return _current_work.set(LLMWork(tenant_id or 0, priority))
+
+
+@contextmanager
+def llm_work(tenant_id: Optional[int] = None, priority: str = "interactive"):
+    token = set_llm_work(tenant_id, priority)
+    try:
+        yield
+    finally:
+        _current_work.reset(token)
+
+
+def _weight(tenant_id: int) -> float:
+    return max(float(settings.TENANT_LLM_WEIGHTS.get(str(tenant_id), 1.0)), 0.01)
+
+
+class TenantLimits:
+    """Per-tenant requests/tokens-per-minute buckets, shared by every provider (created on first use)."""
+
+    def __init__(self):
+        self._buckets: Dict[int, tuple] = {}
+
+    async def acquire(self, tenant_id: int, tokens: float):
+        if not settings.TENANT_LLM_RPM and not settings.TENANT_LLM_TPM:
+            return
+        buckets = self._buckets.get(tenant_id)
+        if buckets is None:
+            buckets = self._buckets[tenant_id] = (
+                TokenBucket(settings.TENANT_LLM_RPM) if settings.TENANT_LLM_RPM else None,
+                TokenBucket(settings.TENANT_LLM_TPM) if settings.TENANT_LLM_TPM else None,
+            )
+        requests, token_bucket = buckets
+        if requests:
+            await requests.acquire()
+        if token_bucket:
+            await token_bucket.acquire(tokens)
+
+
+tenant_limits = TenantLimits()
+
+
+class FairQueue:
+    """
+    Hands out `limit` concurrent slots. Waiters are served by priority class
+    (interactive, background, batch), then by start-time fair queuing between
+    tenants: a tenant's next request starts at max(class clock, its previous
+    finish tag) and finishes cost / weight later, so a tenant with a deep
+    backlog only gets its weighted share while others are waiting.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._heap = [] # (priority, start tag, seq, future)
+        self._seq = itertools.count()
+        self._clock: Dict[int, float] = {}
+        self._finish: Dict[tuple, float] = {}
+
+    def _tag(self, work: LLMWork, cost: float) -> tuple:
+        priority = PRIORITIES[work.priority]
+        start = max(self._clock.get(priority, 0.0), self._finish.get((priority, work.tenant_id), 0.0))
+        self._finish[(priority, work.tenant_id)] = start + cost / _weight(work.tenant_id)
+        return priority, start
+
+    async def acquire(self, work: LLMWork, cost: float):
+        priority, start = self._tag(work, cost)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, start, next(self._seq), future))
+        self._dispatch()
+        try:
+            await future # already resolved when a slot was free
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # granted just as we were cancelled: pass the slot on
+            raise # otherwise the cancelled future is skipped by _dispatch
+
+    def release(self):
+        self.in_use -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._heap and self.in_use < self.limit:
+            priority, start, _, future = heapq.heappop(self._heap)
+            if future.cancelled():
+                continue
+            self.in_use += 1
+            self._clock[priority] = start
+            future.set_result(None)
+
+    def waiting(self) -> Dict[str, int]:
+        names = {value: name for name, value in PRIORITIES.items()}
+        counts = {name: 0 for name in PRIORITIES}
+        for priority, _, _, future in self._heap:
+            if not future.cancelled():
+                counts[names[priority]] += 1
+        return counts
+
+
+class ProviderLimiter:
+    """
+    Concurrency cap for one LLM provider, scheduled fairly between tenants and
+    priorities (FairQueue), plus optional requests/tokens-per-minute caps and
+    queueing metrics.
+    """
+
+    def __init__(self, name: str, limit: int, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.name = name
+        self.limit = limit
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._queue = FairQueue(limit)
+        self._bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.waiting = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @asynccontextmanager
+    async def slot(self, tokens: float = 1.0):
+        work = _current_work.get()
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            # Tenant caps first, so a throttled tenant never holds a provider slot
+            await tenant_limits.acquire(work.tenant_id, tokens)
+            await self._queue.acquire(work, tokens)
+            try:
+                if self._bucket:
+                    await self._bucket.acquire()
+                if self._token_bucket:
+                    await self._token_bucket.acquire(tokens)
+            except BaseException:
+                self._queue.release()
+                raise
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - start
+        self.calls += 1
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._queue.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "requests_per_minute": self.requests_per_minute or None,
+            "tokens_per_minute": self.tokens_per_minute or None,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "queued_by_priority": self._queue.waiting(),
+            "calls": self.calls,
+            "avg_wait_ms": round(self.total_wait_seconds / self.calls * 1000, 2) if self.calls else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+        }
+
+
+provider_limiters: Dict[str, ProviderLimiter] = {
+    "openai": ProviderLimiter("openai", settings.LLM_CONCURRENCY_OPENAI, settings.LLM_RPM_OPENAI, settings.LLM_TPM_OPENAI),
+    "anthropic": ProviderLimiter("anthropic", settings.LLM_CONCURRENCY_ANTHROPIC, settings.LLM_RPM_ANTHROPIC, settings.LLM_TPM_ANTHROPIC),
+    "gemini": ProviderLimiter("gemini", settings.LLM_CONCURRENCY_GEMINI, settings.LLM_RPM_GEMINI, settings.LLM_TPM_GEMINI),
+}
+
+_in_flight = registry.gauge("aiservice_llm_in_flight", "LLM calls holding a provider slot", ["provider"])
+_waiting = registry.gauge("aiservice_llm_waiting", "LLM calls queued for a provider slot", ["provider"])
+
+def _collect_limiters():
+    for name, limiter in provider_limiters.items():
+        _in_flight.set(limiter.in_flight, provider=name)
+        _waiting.set(limiter.waiting, provider=name)
+
+registry.add_collector(_collect_limiters)
+
+def provider_slot(provider: str, tokens: float = 1.0):
+    """
+    Async context manager holding one concurrency slot for the provider, for the
+    tenant/priority set with llm_work(); `tokens` is the estimated cost of the call.
+    """
+    return provider_limiters[provider].slot(tokens)
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List
+
+from core.config import settings
+from core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class NoProviderAvailable(Exception):
+    """Raised when every candidate provider failed or none is configured."""
+
+
+class ProviderHealth:
+    """
+    Rolling latency / error window for one provider plus a circuit breaker:
+    closed -> open when the error rate over the window crosses the threshold,
+    open -> half_open after the cooldown (one probe call), then closed or open again.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.outcomes = deque(maxlen=settings.LLM_BREAKER_WINDOW) # (seconds, ok)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+        self.hedges_won = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= settings.LLM_BREAKER_COOLDOWN_SECONDS:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record(self, seconds: float, ok: bool):
+        self.calls += 1
+        self.failures += 0 if ok else 1
+        self.outcomes.append((seconds, ok))
+        if self.state == "half_open":
+            self.probing = False
+            if ok:
+                logger.info(f"🟢 Circuit for {self.name} closed")
+                self.state = "closed"
+                self.outcomes.clear()
+            else:
+                self._open()
+            return
+        if self.state == "closed" and len(self.outcomes) >= settings.LLM_BREAKER_MIN_CALLS:
+            if self.error_rate() >= settings.LLM_BREAKER_ERROR_RATE:
+                self._open()
+
+    def release_probe(self):
+        # A cancelled probe (lost hedge race) says nothing about health
+        self.probing = False
+
+    def _open(self):
+        logger.warning(f"🔴 Circuit for {self.name} opened (error rate {self.error_rate():.0%})")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+    def p95(self) -> float:
+        latencies = sorted(seconds for seconds, ok in self.outcomes if ok)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "calls": self.calls,
+            "failures": self.failures,
+            "window_error_rate": round(self.error_rate(), 3),
+            "window_p95_ms": round(self.p95() * 1000, 1),
+            "hedges_won": self.hedges_won,
+        }
+
+
+class ProviderRouter:
+    """
+    Picks the provider for an LLM call: the requested one first, then the other
+    configured providers in LLM_FALLBACK_ORDER, skipping open circuits. Failed
+    attempts fail over to the next candidate; with LLM_HEDGE_ENABLED a second
+    provider is started once the first exceeds its recent p95 and the first
+    answer wins.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.health: Dict[str, ProviderHealth] = {name: ProviderHealth(name) for name in names}
+
+    def candidates(self, preferred: str, available: Iterable[str]) -> List[str]:
+        """Configured providers in try order: the requested one, then LLM_FALLBACK_ORDER."""
+        available = set(available)
+        order = [preferred] + [p.strip() for p in settings.LLM_FALLBACK_ORDER.split(",")]
+        return [p for p in dict.fromkeys(order) if p in available and p in self.health]
+
+    def _next(self, queue: List[str], first: bool):
+        """Pops the next provider whose circuit lets a call through (checked lazily: allow() claims half-open probes)."""
+        for index, provider in enumerate(queue):
+            if self.health[provider].allow():
+                return queue.pop(index)
+        if first and queue:
+            # Every circuit open: still try rather than fail without a single call
+            return queue.pop(0)
+        return None
+
+    async def _attempt(self, provider: str, call: Callable[[str], Awaitable[str]]) -> str:
+        health = self.health[provider]
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(call(provider), timeout=settings.LLM_TIMEOUT_SECONDS)
+        except asyncio.CancelledError:
+            health.release_probe()
+            raise
+        except Exception:
+            health.record(time.monotonic() - started, False)
+            raise
+        health.record(time.monotonic() - started, True)
+        return result
+
+    def _hedge_delay(self, provider: str) -> float:
+        return max(self.health[provider].p95(), settings.LLM_HEDGE_MIN_DELAY_MS / 1000)
+
+    async def run(self, preferred: str, available: Iterable[str], call: Callable[[str], Awaitable[str]]) -> str:
+        """Runs call(provider) with failover (and optional hedging); raises NoProviderAvailable if all fail."""
+        queue = self.candidates(preferred, available)
+        if not queue:
+            raise NoProviderAvailable("No LLM provider configured")
+
+        errors = []
+        pending: Dict[asyncio.Task, str] = {}
+        first = True
+        try:
+            while True:
+                if not pending:
+                    provider = self._next(queue, first)
+                    if provider is None:
+                        break
+                    first = False
+                    pending[asyncio.create_task(self._attempt(provider, call))] = provider
+
+                current = next(iter(pending.values()))
+                hedge_at = self._hedge_delay(current)
+                can_hedge = settings.LLM_HEDGE_ENABLED and queue and len(pending) == 1
+                done, _ = await asyncio.wait(pending, timeout=hedge_at if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Slower than usual: race the next provider
+                    provider = self._next(queue, False)
+                    if provider is None:
+                        queue.clear() # nothing healthy to hedge with, just wait
+                        continue
+                    logger.info(f"🏁 Hedging {current} with {provider} after {hedge_at:.2f}s")
+                    pending[asyncio.create_task(self._attempt(provider, call))] = provider
+                    continue
+
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if errors or pending:
+                            logger.info(f"↪️ Answer served by {provider}")
+                        if pending:
+                            self.health[provider].hedges_won += 1
+                        return task.result()
+                    errors.append(f"{provider}: {task.exception()}")
+                    logger.warning(f"⚠️ Provider {provider} failed, failing over: {task.exception()}")
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise NoProviderAvailable("; ".join(errors) or "Every provider circuit is open")
+
+    async def stream(self, preferred: str, available: Iterable[str], open_stream: Callable[[str], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Streams from the first healthy provider; fails over only before the first chunk is sent."""
+        queue = self.candidates(preferred, available)
+        errors = []
+        first = True
+        while True:
+            provider = self._next(queue, first)
+            if provider is None:
+                break
+            first = False
+            health = self.health[provider]
+            started = time.monotonic()
+            sent = False
+            try:
+                async for chunk in open_stream(provider):
+                    sent = True
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                health.release_probe()
+                raise
+            except Exception as e:
+                health.record(time.monotonic() - started, False)
+                if sent:
+                    raise
+                errors.append(f"{provider}: {e}")
+                logger.warning(f"⚠️ Provider {provider} failed before streaming, failing over: {e}")
+                continue
+            health.record(time.monotonic() - started, True)
+            return
+        raise NoProviderAvailable("; ".join(errors) or "No LLM provider configured")
+
+    def stats(self) -> dict:
+        return {name: health.stats() for name, health in self.health.items()}
+
+
+provider_router = ProviderRouter(["openai", "anthropic", "gemini"])
+
+_CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+_circuit = registry.gauge("aiservice_llm_circuit_state", "Provider circuit breaker (0 closed, 1 half open, 2 open)", ["provider"])
+
+def _collect_circuits():
+    for name, health in provider_router.health.items():
+        _circuit.set(_CIRCUIT_STATES[health.state], provider=name)
+
+registry.add_collector(_collect_circuits)
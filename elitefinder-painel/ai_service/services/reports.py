@@ -1,22 +1,36 @@
-from pydantic import BaseModel
-from typing import List, Dict, Any
+import logging
+from pydantic import BaseModel, Field
+from typing import List, Dict, Any, AsyncIterator, Tuple
+from core.config import settings
+from core.metrics import stage
 from services.llm import llm_service
+from services.structured import StructuredOutputError, complete_structured
+from services.rollups import load_report_inputs, period_bounds
+
+logger = logging.getLogger(__name__)
+
+REPORT_DEFAULTS = {
+    "strategic_insight": "Sem insights gerados",
+    "action_items": [],
+    "forecast": "Sem previsão",
+}
 
 class ReportRequest(BaseModel):
     tenant_id: int
     period: str # "daily", "weekly"
-    metrics: Dict[str, Any]
-    alerts_summary: Dict[str, Any]
-    attendant_performance: List[Dict[str, Any]]
+    # Optional with /report?from_rollups=true, which fills them from metric_rollup_daily
+    metrics: Dict[str, Any] = Field(default_factory=dict)
+    alerts_summary: Dict[str, Any] = Field(default_factory=dict)
+    attendant_performance: List[Dict[str, Any]] = Field(default_factory=list)
 
 class ReportResponse(BaseModel):
     strategic_insight: str
     action_items: List[str]
     forecast: str
 
-async def generate_strategic_report(request: ReportRequest, db) -> ReportResponse:
+def build_report_prompt(request: ReportRequest) -> str:
     # Build context for Gemini
-    prompt = f"""
+    return f"""
     Atue como um Diretor de Estratégia (CSO) para esta empresa.
     Gere um relatório de inteligência baseado nos dados abaixo.
     
@@ -44,21 +58,47 @@ async def generate_strategic_report(request: ReportRequest, db) -> ReportRespons
         "forecast": "..."
     }}
     """
-    
-    response_text = await llm_service.generate_report(db, prompt)
-    
+
+async def parse_report_response(response_text: str, db) -> ReportResponse:
+    """Validates the report JSON, re-asking Gemini once with a repair prompt if needed."""
+    async def reask(repair_prompt: str) -> str:
+        return await llm_service.generate_report(db, repair_prompt, json_mode=True)
+
     try:
-        import json
-        clean_text = response_text.replace("```json", "").replace("```", "").strip()
-        data = json.loads(clean_text)
-        return ReportResponse(
-            strategic_insight=data.get("strategic_insight", "Sem insights gerados"),
-            action_items=data.get("action_items", []),
-            forecast=data.get("forecast", "Sem previsão")
+        return await complete_structured(
+            response_text, ReportResponse, kind="report", provider="gemini",
+            reask=reask if settings.LLM_REPAIR_REASK else None, defaults=REPORT_DEFAULTS,
         )
-    except:
+    except StructuredOutputError as e:
+        logger.warning(f"Error parsing report: {e}")
         return ReportResponse(
             strategic_insight=response_text[:500],
             action_items=[],
             forecast="Erro ao estruturar resposta"
         )
+
+async def with_rollup_inputs(request: ReportRequest, db) -> ReportRequest:
+    """Replaces the caller-supplied inputs with the tenant's rollups for the requested period."""
+    start, end = period_bounds(request.period)
+    with stage("report.rollups"):
+        inputs = await load_report_inputs(db, request.tenant_id, start, end)
+    return request.model_copy(update=inputs)
+
+async def generate_strategic_report(request: ReportRequest, db) -> ReportResponse:
+    prompt = build_report_prompt(request)
+    with stage("report.llm"):
+        response_text = await llm_service.generate_report(db, prompt, json_mode=True)
+    with stage("report.parse"):
+        return await parse_report_response(response_text, db)
+
+async def stream_strategic_report(request: ReportRequest, db) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Yields ("token", text) for each Gemini chunk, then ("result", ReportResponse)
+    parsed from the full completion.
+    """
+    prompt = build_report_prompt(request)
+    chunks = []
+    async for chunk in llm_service.stream_report(db, prompt, json_mode=True):
+        chunks.append(chunk)
+        yield "token", chunk
+    yield "result", await parse_report_response("".join(chunks), db)
@@ -0,0 +1,295 @@
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from core.config import settings
+from core.database import engine
+from models.db_models import Atendimento, Mensagem, AnaliseQualidade, MetricRollup
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = [
+    "tickets_opened", "messages_client", "messages_attendant",
+    "response_count", "response_seconds_total",
+    "analyses", "score_total",
+    "sentiment_positive", "sentiment_neutral", "sentiment_negative",
+]
+
+PERIOD_DAYS = {"daily": 1, "weekly": 7, "monthly": 30}
+
+_zone = ZoneInfo(settings.ROLLUP_TIMEZONE)
+
+# (day, tenant_id, attendant_id) -> counter -> delta
+Deltas = Dict[Tuple[date, int, int], Dict[str, float]]
+
+
+def _new_deltas() -> Deltas:
+    return defaultdict(lambda: defaultdict(float))
+
+
+def _as_utc(moment: datetime) -> datetime:
+    # Naive timestamps (legacy TIMESTAMP columns, SQLite) are stored in UTC
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment
+
+
+def _day(moment: datetime) -> date:
+    return _as_utc(moment).astimezone(_zone).date()
+
+
+def _key(moment: datetime, tenant_id: Optional[int], attendant_id: Optional[int]):
+    return _day(moment), tenant_id or 0, attendant_id or 0
+
+
+def _sentiment_column(sentiment: Optional[str]) -> str:
+    value = (sentiment or "").lower()
+    if "negativ" in value:
+        return "sentiment_negative"
+    if "positiv" in value:
+        return "sentiment_positive"
+    return "sentiment_neutral"
+
+
+def _replies(messages: Iterable[tuple]) -> Iterable[Tuple[datetime, float, bool]]:
+    """
+    Walks (sender, sent_at, is_new) messages of one ticket in order and yields
+    (reply_time, seconds_waited, is_new) for each attendant reply, measured from the
+    first client message since the previous reply.
+    """
+    waiting_since = None
+    for sender, sent_at, is_new in messages:
+        if sender == "cliente":
+            if waiting_since is None:
+                waiting_since = sent_at
+        elif waiting_since is not None:
+            waited = (_as_utc(sent_at) - _as_utc(waiting_since)).total_seconds()
+            yield sent_at, max(waited, 0.0), is_new
+            waiting_since = None
+
+
+async def apply_deltas(db, deltas: Deltas):
+    """Adds the deltas to metric_rollup_daily with one multi-row upsert (no commit)."""
+    if not deltas:
+        return
+    rows = [
+        {"day": day, "tenant_id": tenant_id, "attendant_id": attendant_id, **{c: counters.get(c, 0) for c in COUNTERS}}
+        for (day, tenant_id, attendant_id), counters in deltas.items()
+    ]
+    dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(MetricRollup).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["day", "tenant_id", "attendant_id"],
+        set_={c: getattr(MetricRollup, c) + getattr(stmt.excluded, c) for c in COUNTERS},
+    )
+    await db.execute(stmt)
+
+
+async def _ticket_owners(db, ticket_ids: Iterable[int]) -> Dict[int, tuple]:
+    result = await db.execute(
+        select(Atendimento.id_atendimento, Atendimento.id_tenant, Atendimento.id_atendente, Atendimento.data_hora_inicio)
+        .where(Atendimento.id_atendimento.in_(set(ticket_ids)))
+    )
+    return {row.id_atendimento: row for row in result.all()}
+
+
+async def record_messages(db, messages: List[tuple], new_tickets: Iterable[int] = ()):
+    """
+    Updates rollups for freshly inserted (id_mensagem, id_atendimento, sender, sent_at)
+    messages inside the caller's transaction. Response times only cost an extra
+    query when the batch contains attendant replies.
+    """
+    owners = await _ticket_owners(db, [ticket_id for _, ticket_id, _, _ in messages])
+    deltas = _new_deltas()
+
+    for ticket_id in new_tickets:
+        owner = owners.get(ticket_id)
+        if owner:
+            deltas[_key(owner.data_hora_inicio, owner.id_tenant, owner.id_atendente)]["tickets_opened"] += 1
+
+    by_ticket = defaultdict(list)
+    for message_id, ticket_id, sender, sent_at in messages:
+        owner = owners.get(ticket_id)
+        key = _key(sent_at, owner.id_tenant if owner else None, owner.id_atendente if owner else None)
+        deltas[key]["messages_client" if sender == "cliente" else "messages_attendant"] += 1
+        by_ticket[ticket_id].append((message_id, sender, sent_at))
+
+    replied = [ticket_id for ticket_id, items in by_ticket.items() if any(sender != "cliente" for _, sender, _ in items)]
+    if replied:
+        batch_ids = [message_id for message_id, _, _, _ in messages]
+        since = datetime.now(timezone.utc) - timedelta(hours=settings.ROLLUP_RESPONSE_LOOKBACK_HOURS)
+        previous = await db.execute(
+            select(Mensagem.id_atendimento, Mensagem.remetente_tipo, Mensagem.data_hora_envio)
+            .where(
+                Mensagem.id_atendimento.in_(replied),
+                Mensagem.data_hora_envio >= since,
+                Mensagem.id_mensagem.notin_(batch_ids),
+            )
+            .order_by(Mensagem.id_atendimento, Mensagem.data_hora_envio, Mensagem.id_mensagem)
+        )
+        history = defaultdict(list)
+        for ticket_id, sender, sent_at in previous.all():
+            history[ticket_id].append((sender, sent_at, False))
+
+        for ticket_id in replied:
+            owner = owners.get(ticket_id)
+            current = [(sender, sent_at, True) for _, sender, sent_at in by_ticket[ticket_id]]
+            for sent_at, waited, is_new in _replies(history[ticket_id] + current):
+                if is_new:
+                    counters = deltas[_key(sent_at, owner.id_tenant if owner else None, owner.id_atendente if owner else None)]
+                    counters["response_count"] += 1
+                    counters["response_seconds_total"] += waited
+
+    await apply_deltas(db, deltas)
+
+
+async def record_analyses(db, rows: List[dict]):
+    """Updates rollups for new analisequalidade rows (bucketed by the ticket's start day)."""
+    owners = await _ticket_owners(db, [row["id_atendimento"] for row in rows])
+    deltas = _new_deltas()
+    for row in rows:
+        owner = owners.get(row["id_atendimento"])
+        if owner is None:
+            continue
+        counters = deltas[_key(owner.data_hora_inicio, owner.id_tenant, owner.id_atendente)]
+        counters["analyses"] += 1
+        counters["score_total"] += row.get("pontuacao_geral") or 0
+        counters[_sentiment_column(row.get("sentimento_geral"))] += 1
+    await apply_deltas(db, deltas)
+
+
+def _local_bounds(start: date, end: date) -> Tuple[datetime, datetime]:
+    return (
+        datetime.combine(start, datetime.min.time(), _zone).astimezone(timezone.utc),
+        datetime.combine(end + timedelta(days=1), datetime.min.time(), _zone).astimezone(timezone.utc),
+    )
+
+
+async def rebuild(db, start: date, end: date) -> int:
+    """
+    Recomputes the rollups for [start, end] from the base tables. Used for backfills
+    and to pick up analyses written outside ai_service (n8n). Commits.
+    """
+    since, until = _local_bounds(start, end)
+    deltas = _new_deltas()
+
+    tickets = await db.stream(
+        select(Atendimento.id_tenant, Atendimento.id_atendente, Atendimento.data_hora_inicio)
+        .where(Atendimento.data_hora_inicio >= since, Atendimento.data_hora_inicio < until)
+    )
+    async for tenant_id, attendant_id, started_at in tickets:
+        deltas[_key(started_at, tenant_id, attendant_id)]["tickets_opened"] += 1
+
+    messages = await db.stream(
+        select(Mensagem.id_atendimento, Mensagem.remetente_tipo, Mensagem.data_hora_envio, Atendimento.id_tenant, Atendimento.id_atendente)
+        .join(Atendimento, Atendimento.id_atendimento == Mensagem.id_atendimento)
+        .where(Mensagem.data_hora_envio >= since, Mensagem.data_hora_envio < until)
+        .order_by(Mensagem.id_atendimento, Mensagem.data_hora_envio, Mensagem.id_mensagem)
+    )
+    current_ticket, owner, thread = None, None, []
+
+    def close_thread():
+        for sent_at, waited, _ in _replies(thread):
+            counters = deltas[_key(sent_at, *owner)]
+            counters["response_count"] += 1
+            counters["response_seconds_total"] += waited
+
+    async for ticket_id, sender, sent_at, tenant_id, attendant_id in messages:
+        if ticket_id != current_ticket:
+            close_thread()
+            current_ticket, owner, thread = ticket_id, (tenant_id, attendant_id), []
+        deltas[_key(sent_at, tenant_id, attendant_id)]["messages_client" if sender == "cliente" else "messages_attendant"] += 1
+        thread.append((sender, sent_at, True))
+    close_thread()
+
+    analyses = await db.stream(
+        select(AnaliseQualidade.pontuacao_geral, AnaliseQualidade.sentimento_geral, Atendimento.id_tenant, Atendimento.id_atendente, Atendimento.data_hora_inicio)
+        .join(Atendimento, Atendimento.id_atendimento == AnaliseQualidade.id_atendimento)
+        .where(Atendimento.data_hora_inicio >= since, Atendimento.data_hora_inicio < until)
+    )
+    async for score, sentiment, tenant_id, attendant_id, started_at in analyses:
+        counters = deltas[_key(started_at, tenant_id, attendant_id)]
+        counters["analyses"] += 1
+        counters["score_total"] += score or 0
+        counters[_sentiment_column(sentiment)] += 1
+
+    # Boundary days may pick up events from outside the window; only keep days in range
+    deltas = {key: counters for key, counters in deltas.items() if start <= key[0] <= end}
+    await db.execute(delete(MetricRollup).where(MetricRollup.day >= start, MetricRollup.day <= end))
+    await apply_deltas(db, deltas)
+    await db.commit()
+    logger.info(f"📊 Rebuilt {len(deltas)} rollup rows for {start}..{end}")
+    return len(deltas)
+
+
+def period_bounds(period: str, today: date = None) -> Tuple[date, date]:
+    """Maps ReportRequest.period ("daily", "weekly", "monthly" or a number of days) to a day range ending today."""
+    today = today or datetime.now(_zone).date()
+    days = PERIOD_DAYS.get(period) or (int(period) if str(period).isdigit() else 7)
+    return today - timedelta(days=days - 1), today
+
+
+def _minutes(seconds_total: float, count: int) -> Optional[float]:
+    return round(seconds_total / count / 60, 1) if count else None
+
+
+def _average(total: float, count: int) -> Optional[float]:
+    return round(total / count, 2) if count else None
+
+
+async def load_report_inputs(db, tenant_id: int, start: date, end: date) -> dict:
+    """Builds ReportRequest.metrics / alerts_summary / attendant_performance from one grouped rollup query."""
+    result = await db.execute(
+        select(MetricRollup.attendant_id, *[func.sum(getattr(MetricRollup, c)).label(c) for c in COUNTERS])
+        .where(MetricRollup.tenant_id == tenant_id, MetricRollup.day >= start, MetricRollup.day <= end)
+        .group_by(MetricRollup.attendant_id)
+        .order_by(MetricRollup.attendant_id)
+    )
+    rows = result.all()
+    totals = {c: sum(getattr(row, c) or 0 for row in rows) for c in COUNTERS}
+
+    performance = []
+    for row in rows:
+        performance.append({
+            "id_atendente": row.attendant_id,
+            "atendimentos": row.tickets_opened or 0,
+            "mensagens_enviadas": row.messages_attendant or 0,
+            "mensagens_recebidas": row.messages_client or 0,
+            "tempo_medio_resposta_min": _minutes(row.response_seconds_total or 0, row.response_count or 0),
+            "analises": row.analyses or 0,
+            "pontuacao_media": _average(row.score_total or 0, row.analyses or 0),
+            "conversas_negativas": row.sentiment_negative or 0,
+        })
+
+    metrics = {
+        "periodo": f"{start.isoformat()} a {end.isoformat()}",
+        "atendimentos": totals["tickets_opened"],
+        "mensagens_recebidas": totals["messages_client"],
+        "mensagens_enviadas": totals["messages_attendant"],
+        "tempo_medio_resposta_min": _minutes(totals["response_seconds_total"], totals["response_count"]),
+        "conversas_analisadas": totals["analyses"],
+        "pontuacao_media": _average(totals["score_total"], totals["analyses"]),
+        "sentimentos": {
+            "positivo": totals["sentiment_positive"],
+            "neutro": totals["sentiment_neutral"],
+            "negativo": totals["sentiment_negative"],
+        },
+    }
+
+    alerts = {
+        "conversas_negativas": totals["sentiment_negative"],
+        "percentual_negativo": round(100 * totals["sentiment_negative"] / totals["analyses"], 1) if totals["analyses"] else 0,
+        "atendentes_pontuacao_baixa": [
+            p["id_atendente"] for p in performance
+            if p["pontuacao_media"] is not None and p["pontuacao_media"] < settings.REPORT_LOW_SCORE
+        ],
+        "atendentes_resposta_lenta": [
+            p["id_atendente"] for p in performance
+            if p["tempo_medio_resposta_min"] is not None and p["tempo_medio_resposta_min"] > settings.REPORT_SLOW_RESPONSE_MINUTES
+        ],
+    }
+
+    return {"metrics": metrics, "alerts_summary": alerts, "attendant_performance": performance}
@@ -0,0 +1,212 @@
+import asyncio
+import csv
+import io
+import logging
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Iterable, List, Optional, Sequence
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SpreadsheetError(Exception):
+    """Raised when a spreadsheet cannot be previewed (timeout, memory, bad file)."""
+
+
+# --- Worker side (runs in a child process) ---------------------------------
+
+def _limit_memory(max_mb: int):
+    """
+    Pool initializer: caps the worker address space so a hostile file cannot OOM the host.
+    The budget is added on top of what the freshly started worker already maps.
+    """
+    try:
+        import resource
+        try:
+            with open("/proc/self/statm") as statm:
+                current = int(statm.read().split()[0]) * resource.getpagesize()
+        except OSError:
+            current = 0
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = current + max_mb * 1024 * 1024
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (ImportError, ValueError, OSError):
+        pass # not supported on this platform
+
+
+def _kind(value) -> Optional[str]:
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, (datetime, date)):
+        return "date"
+    if isinstance(value, str):
+        try:
+            float(value.replace(",", "."))
+            return "number"
+        except ValueError:
+            return "text"
+    return "text"
+
+
+def _as_float(value) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _profile(title: str, header: Sequence, rows: List[Sequence], truncated: bool, sample_rows: int) -> str:
+    """Column profile (type, nulls, distinct, numeric summary) plus a few sample rows as CSV."""
+    width = max([len(header)] + [len(row) for row in rows]) if rows or header else 0
+    names = [str(h) if h not in (None, "") else f"col_{i + 1}" for i, h in enumerate(list(header) + [None] * (width - len(header)))]
+
+    lines = [f"## {title}: {len(rows)}{'+' if truncated else ''} linhas x {width} colunas"]
+    for index, name in enumerate(names):
+        values = [row[index] if index < len(row) else None for row in rows]
+        kinds = {}
+        nulls = 0
+        for value in values:
+            kind = _kind(value)
+            if kind is None:
+                nulls += 1
+            else:
+                kinds[kind] = kinds.get(kind, 0) + 1
+        dominant = max(kinds, key=kinds.get) if kinds else "vazio"
+        distinct = len({str(v) for v in values if _kind(v) is not None})
+        line = f"- {name}: tipo={dominant}, nulos={nulls}, distintos={distinct}"
+        if dominant == "number":
+            numbers = [n for n in (_as_float(v) for v in values if _kind(v) == "number") if n is not None and math.isfinite(n)]
+            if numbers:
+                line += f", min={min(numbers):g}, max={max(numbers):g}, media={sum(numbers) / len(numbers):.4g}, soma={sum(numbers):.4g}"
+        lines.append(line)
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(names)
+    for row in rows[:sample_rows]:
+        writer.writerow(["" if v is None else v for v in row])
+    lines.append(f"Amostra ({min(sample_rows, len(rows))} linhas):")
+    lines.append(out.getvalue().strip())
+    return "\n".join(lines)
+
+
+def _take(rows: Iterable[Sequence], max_rows: int):
+    """Reads header + up to max_rows data rows without materializing the rest."""
+    iterator = iter(rows)
+    header = next(iterator, ())
+    taken = []
+    for row in iterator:
+        if len(taken) >= max_rows:
+            return header, taken, True
+        if any(v not in (None, "") for v in row):
+            taken.append(row)
+    return header, taken, False
+
+
+def build_preview(data: bytes, mime_type: str, filename: str, max_rows: int, max_sheets: int, sample_rows: int) -> str:
+    """Builds the compact preview. Runs inside the process pool."""
+    name = (filename or "").lower()
+    if "csv" in mime_type or name.endswith(".csv"):
+        text = data.decode("utf-8-sig", errors="replace")
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        header, rows, truncated = _take(csv.reader(io.StringIO(text), dialect), max_rows)
+        return _profile("CSV", header, rows, truncated, sample_rows)
+
+    if name.endswith(".xls") or "ms-excel" in mime_type:
+        # Legacy binary workbooks: openpyxl cannot read them, pandas only loads the rows we ask for
+        import pandas as pd
+        try:
+            sheets = pd.read_excel(io.BytesIO(data), sheet_name=None, nrows=max_rows + 1, header=None)
+        except ImportError as e:
+            raise SpreadsheetError("Legacy .xls spreadsheets need the xlrd package (see requirements.txt)") from e
+        sections = []
+        for title, df in list(sheets.items())[:max_sheets]:
+            records = df.astype(object).where(df.notna(), None).values.tolist()
+            header, rows, truncated = _take(records, max_rows)
+            sections.append(_profile(str(title), header, rows, truncated, sample_rows))
+        return "\n\n".join(sections)
+
+    from openpyxl import load_workbook
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        sections = []
+        for sheet in workbook.worksheets[:max_sheets]:
+            header, rows, truncated = _take(sheet.iter_rows(values_only=True), max_rows)
+            sections.append(_profile(sheet.title, header, rows, truncated, sample_rows))
+        if len(workbook.worksheets) > max_sheets:
+            sections.append(f"(+{len(workbook.worksheets) - max_sheets} abas omitidas)")
+        return "\n\n".join(sections)
+    finally:
+        workbook.close()
+
+
+# --- Event loop side ----------------------------------------------------------
+
+class SpreadsheetProcessor:
+    """Runs build_preview in a small process pool with a timeout and a per-worker memory cap."""
+
+    def __init__(self):
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=settings.SPREADSHEET_WORKERS,
+                # spawn: never fork the threaded event-loop process
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_limit_memory,
+                initargs=(settings.SPREADSHEET_MEMORY_LIMIT_MB,),
+            )
+        return self._pool
+
+    async def preview(self, data: bytes, mime_type: str, filename: str = None) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._get_pool(), build_preview,
+            data, mime_type, filename or "",
+            settings.SPREADSHEET_MAX_ROWS, settings.SPREADSHEET_MAX_SHEETS, settings.SPREADSHEET_SAMPLE_ROWS,
+        )
+        try:
+            return await asyncio.wait_for(future, timeout=settings.SPREADSHEET_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._reset_pool() # the stuck worker cannot be cancelled, only killed
+            raise SpreadsheetError(f"Spreadsheet preview timed out after {settings.SPREADSHEET_TIMEOUT}s")
+        except MemoryError:
+            raise SpreadsheetError("Spreadsheet preview exceeded the worker memory limit")
+        except Exception as e:
+            if type(e).__name__ == "BrokenProcessPool":
+                self._reset_pool()
+            raise SpreadsheetError(f"Could not read spreadsheet: {e}") from e
+
+    def _reset_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        for process in list(getattr(pool, "_processes", {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+spreadsheet_processor = SpreadsheetProcessor()
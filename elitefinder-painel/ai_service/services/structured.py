@@ -0,0 +1,182 @@
+import json
+import logging
+import re
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from core.metrics import llm_structured_outputs
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T", bound=BaseModel)
+
+# Texts llm_service returns instead of raising; re-asking would only repeat the failure
+LLM_ERROR_PREFIXES = ("Erro", "Nenhum provedor")
+
+# How much of a broken answer is quoted back in the repair prompt
+REPAIR_QUOTE_CHARS = 6000
+
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class StructuredOutputError(ValueError):
+    """Raised when an LLM answer cannot be turned into the expected schema."""
+
+
+def _scan(text: str, start: int) -> str:
+    """
+    Single pass over mixed text: copies the JSON object/array opening at `start`,
+    dropping trailing commas and closing strings/brackets left open by a truncated answer.
+    """
+    out, stack = [], []
+    in_string = escaped = False
+    for c in text[start:]:
+        if in_string:
+            out.append(c)
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if not stack or stack.pop() != c:
+                raise StructuredOutputError("unbalanced brackets in the answer")
+            out.append(c)
+            if not stack:
+                return "".join(out)
+            continue
+        if c == '"':
+            in_string = True
+        elif c in _CLOSERS:
+            stack.append(_CLOSERS[c])
+        out.append(c)
+
+    # Ran out of text (max_tokens hit): close what is still open
+    if in_string:
+        out.append('"')
+    while out and (out[-1].isspace() or out[-1] == ","):
+        out.pop()
+    out.extend(reversed(stack))
+    return "".join(out)
+
+
+def _extract(text: str, objects_only: bool = False) -> Tuple[Any, bool]:
+    """
+    Returns (data, repaired); repaired is False when the answer was clean JSON (fences allowed).
+    Otherwise each `{` (or `[` too, unless objects_only) is tried in turn, so prose
+    brackets such as "Resultado [v2]: {...}" do not hide the object that follows.
+    """
+    clean = _FENCE.sub("", text.strip())
+    try:
+        return json.loads(clean, strict=False), False
+    except ValueError:
+        pass
+    openers = "{" if objects_only else "{["
+    error = None
+    for start, c in enumerate(clean):
+        if c not in openers:
+            continue
+        try:
+            return json.loads(_scan(clean, start), strict=False), True
+        except ValueError as e:
+            error = error or e # the first candidate's error is the most telling
+    if error is None:
+        raise StructuredOutputError("no JSON object in the answer")
+    raise StructuredOutputError(f"invalid JSON: {error}") from error
+
+
+def extract_json(text: str, objects_only: bool = False) -> Any:
+    """Parses the JSON payload of an LLM answer, tolerating prose, fences, trailing commas and truncation."""
+    return _extract(text or "", objects_only)[0]
+
+
+def _validate(text: str, schema: Type[T], defaults: Optional[Dict[str, Any]], fields: Dict[str, Any]) -> Tuple[T, bool]:
+    data, repaired = _extract(text or "", objects_only=True)
+    if not isinstance(data, dict):
+        raise StructuredOutputError(f"expected a JSON object, got {type(data).__name__}")
+    defaults = defaults or {}
+    # null for a field with a default means "not provided"
+    data = {k: v for k, v in data.items() if v is not None or k not in defaults}
+    try:
+        return schema.model_validate({**defaults, **data, **fields}), repaired
+    except ValidationError as e:
+        problems = "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+        raise StructuredOutputError(problems) from e
+
+
+def parse_structured(text: str, schema: Type[T], defaults: Dict[str, Any] = None, **fields) -> T:
+    """Extracts, repairs and validates an answer against `schema`; `fields` are set by the caller, not the model."""
+    return _validate(text, schema, defaults, fields)[0]
+
+
+def build_repair_prompt(text: str, schema: Type[BaseModel], error: str, exclude=()) -> str:
+    """Targeted re-ask: the validation error, the expected fields and the broken answer."""
+    properties = schema.model_json_schema().get("properties", {})
+    expected = ", ".join(
+        f'"{name}": {spec.get("type") or "string"}' for name, spec in properties.items() if name not in exclude
+    )
+    return f"""
+    Sua resposta anterior não pôde ser lida como o JSON esperado.
+
+    ERRO: {error}
+
+    CAMPOS ESPERADOS: {{{expected}}}
+
+    RESPOSTA ANTERIOR:
+    {text[:REPAIR_QUOTE_CHARS]}
+
+    Corrija a resposta mantendo o mesmo conteúdo.
+    Responda EXCLUSIVAMENTE com o JSON válido, sem markdown e sem comentários.
+    """
+
+
+async def complete_structured(
+    text: str,
+    schema: Type[T],
+    *,
+    kind: str,
+    provider: str,
+    reask: Optional[Callable[[str], Awaitable[str]]] = None,
+    defaults: Dict[str, Any] = None,
+    **fields,
+) -> T:
+    """
+    Parses an answer into `schema`; only when local extraction/repair fails and
+    `reask` is given, asks the model once more with a repair prompt.
+    Outcomes are counted per provider in aiservice_llm_structured_outputs_total.
+    Raises StructuredOutputError when no valid object could be obtained.
+    """
+    def count(outcome: str):
+        llm_structured_outputs.inc(provider=provider, kind=kind, outcome=outcome)
+
+    if (text or "").startswith(LLM_ERROR_PREFIXES):
+        count("llm_error")
+        raise StructuredOutputError(text[:200])
+
+    try:
+        result, repaired = _validate(text, schema, defaults, fields)
+        count("repaired" if repaired else "ok")
+        return result
+    except StructuredOutputError as e:
+        if reask is None:
+            count("failed")
+            raise
+        error = str(e)
+
+    logger.warning(f"🔧 Unparseable {kind} answer from {provider}, asking for a repair: {error}")
+    retry = await reask(build_repair_prompt(text, schema, error, exclude=fields.keys()))
+    try:
+        result, _ = _validate(retry, schema, defaults, fields)
+    except StructuredOutputError:
+        count("failed")
+        raise
+    count("reasked")
+    return result
@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from core.config import settings
+
+
+class TicketCache:
+    """
+    In-process LRU of phone -> open id_atendimento.
+    Entries also expire after TICKET_CACHE_TTL_SECONDS so tickets closed outside
+    ai_service (painel, n8n) are picked up without an explicit invalidation.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, phone: str) -> Optional[int]:
+        entry = self._entries.get(phone)
+        if entry is None:
+            self.misses += 1
+            return None
+        ticket_id, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[phone]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(phone)
+        self.hits += 1
+        return ticket_id
+
+    def get_many(self, phones: Iterable[str]) -> Dict[str, int]:
+        found = {}
+        for phone in phones:
+            ticket_id = self.get(phone)
+            if ticket_id is not None:
+                found[phone] = ticket_id
+        return found
+
+    def put(self, phone: str, ticket_id: int):
+        self._entries[phone] = (ticket_id, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(phone)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, phone: str):
+        self._entries.pop(phone, None)
+
+    def invalidate_ticket(self, ticket_id: int):
+        for phone, (cached_id, _) in list(self._entries.items()):
+            if cached_id == ticket_id:
+                del self._entries[phone]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+ticket_cache = TicketCache(settings.TICKET_CACHE_SIZE, settings.TICKET_CACHE_TTL_SECONDS)
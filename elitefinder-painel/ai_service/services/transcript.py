@@ -0,0 +1,96 @@
+from dataclasses import dataclass
+from typing import Iterable, List
+
+from schemas.analysis import Message
+
+# ~4 characters per token holds well enough for Portuguese chat text with GPT/Claude/Gemini tokenizers
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (no tokenizer dependency)."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@dataclass
+class Turn:
+    role: str
+    content: str
+
+    def render(self) -> str:
+        return f"{self.role}: {self.content}"
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.render()) + 1 # newline
+
+
+def collapse_turns(messages: Iterable[Message], max_turn_tokens: int = None) -> List[Turn]:
+    """
+    Merges consecutive messages from the same sender into one turn
+    ("Show" / "Este" / "Ah show" -> one line) and trims runaway turns.
+    """
+    turns: List[Turn] = []
+    for msg in messages:
+        content = (msg.content or "").strip()
+        if not content:
+            continue
+        if turns and turns[-1].role == msg.role:
+            turns[-1].content += " / " + content
+        else:
+            turns.append(Turn(msg.role, content))
+
+    if max_turn_tokens:
+        max_chars = max_turn_tokens * CHARS_PER_TOKEN
+        for turn in turns:
+            if len(turn.content) > max_chars:
+                turn.content = turn.content[:max_chars] + " [...]"
+    return turns
+
+
+def render_transcript(turns: Iterable[Turn]) -> str:
+    return "".join(turn.render() + "\n" for turn in turns)
+
+
+def transcript_tokens(turns: Iterable[Turn]) -> int:
+    return sum(turn.tokens for turn in turns)
+
+
+def chunk_turns(turns: List[Turn], chunk_tokens: int) -> List[List[Turn]]:
+    """Greedy split into consecutive chunks of at most chunk_tokens (a single oversized turn gets its own chunk)."""
+    chunks: List[List[Turn]] = []
+    current: List[Turn] = []
+    used = 0
+    for turn in turns:
+        if current and used + turn.tokens > chunk_tokens:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(turn)
+        used += turn.tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def fit_turns(turns: List[Turn], budget: int) -> List[Turn]:
+    """
+    Trims a transcript to roughly `budget` tokens for single-call prompts:
+    keeps the opening (greeting) and the most recent turns (outcome) and marks the gap.
+    """
+    if transcript_tokens(turns) <= budget:
+        return turns
+    head, used = [], 0
+    for turn in turns:
+        if used + turn.tokens > budget // 4:
+            break
+        head.append(turn)
+        used += turn.tokens
+    tail = []
+    for turn in reversed(turns[len(head):]):
+        if used + turn.tokens > budget:
+            break
+        tail.append(turn)
+        used += turn.tokens
+    tail.reverse()
+    omitted = len(turns) - len(head) - len(tail)
+    return head + [Turn("sistema", f"[{omitted} trechos omitidos]")] + tail
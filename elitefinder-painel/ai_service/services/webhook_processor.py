@@ -1,37 +1,60 @@
 import logging
 from typing import Dict, Any
 from schemas.waha import WahaWebhookPayload, WahaMessage
+from core.metrics import stage, webhook_messages, webhook_duplicates
+from services.dedup import seen_messages
+from services.debouncer import analysis_debouncer
+from core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# We only care about incoming messages for now
+HANDLED_EVENTS = ["message", "message.any"]
+
 async def process_waha_payload(payload: WahaWebhookPayload):
     """
     Main entry point for processing WAHA webhooks.
+    Errors are re-raised so the webhook queue can retry the job.
     """
     event = payload.event
     
-    # We only care about incoming messages for now
-    if event not in ["message", "message.any"]:
+    if event not in HANDLED_EVENTS:
         return
 
     message = payload.payload
     chat_id = message.from_
+
+    # Before any DB write or media download: message + message.any and WAHA retries share the id
+    if not seen_messages.claim(message.id):
+        webhook_duplicates.inc(stage="worker")
+        logger.info(f"♻️ Skipping duplicate delivery of {message.id}")
+        return
     
     logger.info(f"🤖 Processing message from {chat_id} | Type: {message._data.get('type', 'text') if message._data else 'unknown'}")
 
+    kind = "media" if message.hasMedia or message.type in ["image", "ptt", "audio", "document"] else "text"
     try:
-        if message.hasMedia or message.type in ["image", "ptt", "audio", "document"]:
-            await handle_media_message(message)
-        else:
-            await handle_text_message(message)
+        with stage(f"webhook.{kind}"):
+            if kind == "media":
+                await handle_media_message(message)
+            else:
+                await handle_text_message(message)
             
     except Exception as e:
+        seen_messages.release(message.id)
+        webhook_messages.inc(kind=kind, outcome="error")
         logger.error(f"❌ Error processing message {message.id}: {str(e)}", exc_info=True)
+        raise
+    webhook_messages.inc(kind=kind, outcome="ok")
 
 import httpx
 from services.llm import llm_service
-from services.message_service import message_service
+from services.message_service import message_service, normalize_phone
+from services.media import download_media, DownloadedMedia, MediaTooLargeError
+from services.spreadsheet import spreadsheet_processor, SpreadsheetError
+from services.provider_limits import llm_work
 from core.database import SessionLocal
+from core.http import http_clients
 
 async def handle_text_message(message: WahaMessage):
     """
@@ -39,30 +62,37 @@ async def handle_text_message(message: WahaMessage):
     """
     logger.info(f"📝 Text Message: {message.body}")
     
-    # DB Persistence
-    db = SessionLocal()
-    try:
-        contact_name = message._data.get("notifyName", "Desconhecido") if message._data else "Desconhecido"
-        # Extract phone number from remoteJid or from_
-        phone = message.from_
-        
-        await message_service.save_message(
-            db=db, 
-            phone_number=phone, 
-            message_text=message.body or "", 
-            sender_type="cliente", 
-            contact_name=contact_name
-        )
-    except Exception as e:
-        logger.error(f"❌ Failed to save message: {e}")
-    finally:
-        db.close()
+    # DB Persistence (batched by MessageService)
+    contact_name = message._data.get("notifyName", "Desconhecido") if message._data else "Desconhecido"
+    # Extract phone number from remoteJid or from_
+    phone = message.from_
+    if normalize_phone(phone) is None:
+        # Groups, broadcasts and newsletters have no ticket; retrying would never help
+        logger.info(f"⏭️ Not storing message {message.id} from non-contact chat {phone}")
+        return
+    
+    saved = await message_service.save_message(
+        phone_number=phone, 
+        message_text=message.body or "", 
+        sender_type="cliente", 
+        contact_name=contact_name,
+        external_id=message.id
+    )
+    if saved is None:
+        raise RuntimeError(f"Failed to save message {message.id}")
+    if saved.duplicate:
+        webhook_duplicates.inc(stage="database")
+        return
     
-    # TODO: Integrate with AI Analysis (Auto-Reply)
+    # One analysis per burst of short messages, not one per fragment
+    if settings.ANALYSIS_ON_MESSAGE:
+        analysis_debouncer.touch(saved.id_atendimento)
 
 async def handle_media_message(message: WahaMessage):
     """
     Process media messages (Image, Audio, Doc).
+    Permanent download failures (too large, 4xx) skip the media; transport
+    errors and 5xx propagate so the webhook queue retries the job.
     """
     media_url = message.media.url if message.media else None
     mime_type = message.media.mimetype if message.media else "unknown"
@@ -73,59 +103,61 @@ async def handle_media_message(message: WahaMessage):
 
     logger.info(f"📎 Downloading Media ({message.type}): {mime_type} | URL: {media_url}")
     
-    # Download Media
-    async with httpx.AsyncClient() as client:
-        try:
-            # WAHA sends a local URL sometimes, or a public one. 
-            # If it's a file from WAHA, we might need headers if auth is enabled?
-            # For now assuming public or accessible URL provided by WAHA's file server
-            response = await client.get(media_url, timeout=30.0)
-            if response.status_code != 200:
-                logger.error(f"❌ Failed to download media: {response.status_code}")
-                return
-            
-            media_bytes = response.content
-            logger.info(f"✅ Download complete: {len(media_bytes)} bytes")
-            
-        except Exception as e:
-            logger.error(f"❌ Error downloading media: {e}")
+    # Download Media (streamed, size-capped, hashed on the fly) over the shared pooled client
+    try:
+        # WAHA sends a local URL sometimes, or a public one. 
+        # If it's a file from WAHA, we might need headers if auth is enabled?
+        # For now assuming public or accessible URL provided by WAHA's file server
+        with stage("media.download"):
+            media = await download_media(http_clients.get("media"), media_url, mime_type)
+        logger.info(f"✅ Download complete: {media.size} bytes | sha256 {media.sha256[:12]}")
+        
+    except MediaTooLargeError as e:
+        logger.warning(f"⚠️ Skipping media {message.id}: {e}")
+        return
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code < 500 and e.response.status_code != 429:
+            # 4xx (expired / unknown file) will not succeed on retry
+            logger.error(f"❌ Failed to download media {message.id}: {e.response.status_code}")
             return
+        raise # 5xx / 429: let the webhook queue retry with backoff
 
+    with media, stage("media.analyze"), llm_work(None, "background"):
+        await _analyze_downloaded_media(media, mime_type, message.media.filename)
+
+async def _analyze_downloaded_media(media: DownloadedMedia, mime_type: str, filename: str = None):
+    """
+    Routes a downloaded file to the right analyzer by mime type.
+    """
     # Create DB Session for config lookup
-    from core.database import SessionLocal
-    db = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         # Route based on Type
         if "image" in mime_type:
             logger.info("📸 Detected Image -> Sending to Gemini Vision...")
-            description = await llm_service.analyze_media(db, media_bytes, mime_type, "Descreva esta imagem e extraia informações relevantes (nomes, valores, datas) se houver.")
+            description = await llm_service.analyze_media(db, media, mime_type, "Descreva esta imagem e extraia informações relevantes (nomes, valores, datas) se houver.")
             logger.info(f"🧠 Image Analysis: {description}")
             
         elif "audio" in mime_type or "ogg" in mime_type:
             logger.info("🎤 Detected Audio -> Sending to Gemini Audio...")
-            transcription = await llm_service.analyze_media(db, media_bytes, mime_type, "Transcreva este áudio fielmente. Se houver instruções, identifique-as.")
+            transcription = await llm_service.analyze_media(db, media, mime_type, "Transcreva este áudio fielmente. Se houver instruções, identifique-as.")
             logger.info(f"🗣️ Audio Transcription: {transcription}")
             
         elif "pdf" in mime_type:
             logger.info("qh Detected PDF -> Sending to Gemini Docs...")
-            summary = await llm_service.analyze_media(db, media_bytes, mime_type, "Resuma este documento e extraia os pontos principais.")
+            summary = await llm_service.analyze_media(db, media, mime_type, "Resuma este documento e extraia os pontos principais.")
             logger.info(f"📄 PDF Analysis: {summary}")
             
-        elif "spreadsheet" in mime_type or "excel" in mime_type:
-            logger.info("📊 Detected Excel -> Processing with Pandas...")
-            import pandas as pd
-            import io
+        elif "spreadsheet" in mime_type or "excel" in mime_type or "csv" in mime_type:
+            logger.info("📊 Detected Spreadsheet -> Profiling off the event loop...")
             try:
-                df = pd.read_excel(io.BytesIO(media_bytes))
-                csv_preview = df.head(50).to_csv(index=False) # Limit to 50 rows for token sanity
+                with stage("spreadsheet.preview"):
+                    preview = await spreadsheet_processor.preview(media.read(), mime_type, filename)
                 
                 analysis = await llm_service.analyze_conversation(
                     db,
-                    f"Analise esta planilha (primeiras 50 linhas):\n{csv_preview}\n\nQuais são os insights principais? Responda de forma executiva.", 
+                    f"Analise esta planilha (perfil das colunas e amostra de linhas):\n{preview}\n\nQuais são os insights principais? Responda de forma executiva.", 
                     provider="openai" # Or Gemini
                 )
-                logger.info(f"📊 Excel Analysis: {analysis}")
-            except Exception as e:
-                logger.error(f"❌ Error processing Excel: {e}")
-    finally:
-        db.close()
+                logger.info(f"📊 Spreadsheet Analysis: {analysis}")
+            except SpreadsheetError as e:
+                logger.error(f"❌ Error processing spreadsheet: {e}")
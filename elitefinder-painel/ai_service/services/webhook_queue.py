@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, delete, func
+
+from core.config import settings
+from core.metrics import registry
+from core.database import SessionLocal
+from models.db_models import WebhookJob
+from schemas.waha import WahaWebhookPayload
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the pending backlog exceeds WEBHOOK_QUEUE_MAX_DEPTH."""
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class WebhookQueue:
+    """
+    Postgres-backed queue between the WAHA webhook and process_waha_payload.
+    Jobs survive restarts, are claimed with SKIP LOCKED so several workers
+    (and several uvicorn processes) can drain the same table, and are retried
+    with exponential backoff before being dead-lettered.
+    """
+
+    def __init__(self):
+        self._workers = []
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._depth = 0 # approximate pending jobs, resynced from the DB by the reaper
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    async def enqueue(self, payload: WahaWebhookPayload) -> int:
+        """Persists the payload and wakes a worker. Raises QueueFullError on backpressure."""
+        if self._depth >= settings.WEBHOOK_QUEUE_MAX_DEPTH:
+            raise QueueFullError(f"Webhook queue depth {self._depth} >= {settings.WEBHOOK_QUEUE_MAX_DEPTH}")
+
+        async with SessionLocal() as db:
+            job = WebhookJob(
+                payload=payload.model_dump(mode="json", by_alias=True),
+                status="pending",
+                attempts=0,
+                available_at=_now(),
+                created_at=_now(),
+            )
+            db.add(job)
+            await db.commit()
+
+        self._depth += 1
+        self._wakeup.set()
+        return job.id
+
+    async def start(self):
+        """Starts the worker pool and the reaper. Called from the app startup hook."""
+        self._stopping.clear()
+        await self._requeue_stale()
+        await self._refresh_depth()
+        for i in range(settings.WEBHOOK_QUEUE_WORKERS):
+            self._workers.append(asyncio.create_task(self._worker(i), name=f"webhook-worker-{i}"))
+        self._workers.append(asyncio.create_task(self._reaper(), name="webhook-reaper"))
+        logger.info(f"📬 Webhook queue started with {settings.WEBHOOK_QUEUE_WORKERS} workers (depth {self._depth})")
+
+    async def stop(self, timeout: float = 10.0):
+        """Lets in-flight jobs finish, then cancels the workers."""
+        self._stopping.set()
+        self._wakeup.set()
+        if not self._workers:
+            return
+        _, pending = await asyncio.wait(self._workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._workers = []
+
+    async def stats(self) -> dict:
+        async with SessionLocal() as db:
+            result = await db.execute(select(WebhookJob.status, func.count()).group_by(WebhookJob.status))
+            counts = {status: count for status, count in result.all()}
+        return {
+            "workers": settings.WEBHOOK_QUEUE_WORKERS,
+            "max_depth": settings.WEBHOOK_QUEUE_MAX_DEPTH,
+            "pending": counts.get("pending", 0),
+            "processing": counts.get("processing", 0),
+            "dead": counts.get("dead", 0),
+        }
+
+    async def retry_dead(self) -> int:
+        """Moves every dead-lettered job back to pending."""
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(WebhookJob)
+                .where(WebhookJob.status == "dead")
+                .values(status="pending", attempts=0, available_at=_now(), locked_at=None)
+            )
+            await db.commit()
+        self._depth += result.rowcount
+        self._wakeup.set()
+        return result.rowcount
+
+    async def _claim(self):
+        # Retry a few times when another worker wins the race for the same row
+        for _ in range(3):
+            job = await self._try_claim()
+            if job is not False:
+                return job
+        return None
+
+    async def _try_claim(self):
+        """Returns the claimed job, None when nothing is due, or False when the claim was lost."""
+        async with SessionLocal() as db:
+            result = await db.execute(
+                select(WebhookJob)
+                .where(WebhookJob.status == "pending", WebhookJob.available_at <= _now())
+                .order_by(WebhookJob.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            job = result.scalars().first()
+            if not job:
+                return None
+            # Conditional update keeps the claim exclusive on backends without SKIP LOCKED
+            claimed = await db.execute(
+                update(WebhookJob)
+                .where(
+                    WebhookJob.id == job.id,
+                    WebhookJob.status == "pending",
+                    WebhookJob.attempts == job.attempts, # acts as a version stamp
+                )
+                .values(status="processing", attempts=job.attempts + 1, locked_at=_now())
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            if claimed.rowcount != 1:
+                return False
+            job.attempts += 1
+            return job
+
+    @staticmethod
+    def _owned(job: WebhookJob):
+        # attempts is bumped on every claim, so it identifies this claim of the job:
+        # a worker whose job was re-queued and claimed again matches nothing
+        return (WebhookJob.id == job.id, WebhookJob.status == "processing", WebhookJob.attempts == job.attempts)
+
+    async def _heartbeat(self, job: WebhookJob):
+        """Keeps locked_at fresh while the job runs, so the reaper only re-queues jobs of dead workers."""
+        interval = settings.WEBHOOK_QUEUE_VISIBILITY_TIMEOUT / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with SessionLocal() as db:
+                    result = await db.execute(update(WebhookJob).where(*self._owned(job)).values(locked_at=_now()))
+                    await db.commit()
+                if result.rowcount != 1:
+                    logger.warning(f"⚠️ Lost the claim on webhook job {job.id} while processing it")
+                    return
+            except Exception as e:
+                logger.error(f"❌ Heartbeat for webhook job {job.id} failed: {e}")
+
+    async def _finish(self, job: WebhookJob, error: Exception = None):
+        async with SessionLocal() as db:
+            if error is None:
+                result = await db.execute(delete(WebhookJob).where(*self._owned(job)))
+            elif job.attempts >= settings.WEBHOOK_QUEUE_MAX_ATTEMPTS:
+                result = await db.execute(
+                    update(WebhookJob)
+                    .where(*self._owned(job))
+                    .values(status="dead", locked_at=None, last_error=str(error)[:2000])
+                )
+            else:
+                delay = min(
+                    settings.WEBHOOK_QUEUE_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1)),
+                    settings.WEBHOOK_QUEUE_RETRY_MAX_SECONDS,
+                )
+                delay *= random.uniform(0.8, 1.2) # jitter so retries don't stampede
+                result = await db.execute(
+                    update(WebhookJob)
+                    .where(*self._owned(job))
+                    .values(
+                        status="pending",
+                        locked_at=None,
+                        available_at=_now() + timedelta(seconds=delay),
+                        last_error=str(error)[:2000],
+                    )
+                )
+            await db.commit()
+        if result.rowcount != 1:
+            # Re-queued by the reaper and claimed again: that claim owns the job now
+            logger.warning(f"⚠️ Webhook job {job.id} was re-claimed; dropping the outcome of attempt {job.attempts}")
+        elif error is None:
+            self._depth = max(0, self._depth - 1)
+        elif job.attempts >= settings.WEBHOOK_QUEUE_MAX_ATTEMPTS:
+            logger.error(f"☠️ Webhook job {job.id} dead-lettered after {job.attempts} attempts: {error}")
+            self._depth = max(0, self._depth - 1)
+        else:
+            logger.warning(f"🔁 Webhook job {job.id} failed (attempt {job.attempts}), retrying in {delay:.1f}s: {error}")
+
+    async def _worker(self, index: int):
+        from services.webhook_processor import process_waha_payload
+
+        while not self._stopping.is_set():
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"❌ Worker {index} failed to claim a job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.WEBHOOK_QUEUE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            error = None
+            heartbeat = asyncio.create_task(self._heartbeat(job))
+            try:
+                await process_waha_payload(WahaWebhookPayload.model_validate(job.payload))
+            except Exception as e:
+                error = e
+            finally:
+                heartbeat.cancel()
+
+            try:
+                await self._finish(job, error)
+            except Exception as e:
+                # The reaper will re-queue the job once its visibility timeout expires
+                logger.error(f"❌ Worker {index} failed to finalize job {job.id}: {e}")
+
+    async def _reaper(self):
+        """Re-queues jobs orphaned by a crashed worker (no heartbeat) and resyncs the depth gauge."""
+        interval = max(settings.WEBHOOK_QUEUE_VISIBILITY_TIMEOUT / 4, settings.WEBHOOK_QUEUE_POLL_INTERVAL)
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._requeue_stale()
+                await self._refresh_depth()
+            except Exception as e:
+                logger.error(f"❌ Webhook queue reaper failed: {e}")
+
+    async def _requeue_stale(self):
+        cutoff = _now() - timedelta(seconds=settings.WEBHOOK_QUEUE_VISIBILITY_TIMEOUT)
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(WebhookJob)
+                .where(WebhookJob.status == "processing", WebhookJob.locked_at < cutoff)
+                .values(status="pending", locked_at=None, available_at=_now())
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.warning(f"♻️ Re-queued {result.rowcount} stale webhook jobs")
+
+    async def _refresh_depth(self):
+        async with SessionLocal() as db:
+            result = await db.execute(
+                select(func.count()).select_from(WebhookJob).where(WebhookJob.status.in_(["pending", "processing"]))
+            )
+            self._depth = result.scalar_one()
+
+
+webhook_queue = WebhookQueue()
+
+_depth_gauge = registry.gauge("aiservice_webhook_queue_depth", "Pending + processing webhook jobs (approximate)")
+registry.add_collector(lambda: _depth_gauge.set(webhook_queue.depth))
@@ -2,6 +2,8 @@
 cd ai_service
 echo Instalando dependencias...
 pip install -r requirements.txt
+echo Atualizando schema do banco...
+python init_tables.py
 echo Iniciando servico de IA...
 python main.py
 pause
@@ -1,10 +1,47 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from urllib.parse import urlparse
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
+import logging
+import os
 import time
 import asyncio
 
-app = FastAPI()
+try:
+    import asyncpg
+except ImportError:  # sem driver: a sonda do Postgres cai para um connect TCP
+    asyncpg = None
+
+logger = logging.getLogger("status_api")
+
+
+def _http2_disponivel() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Um único cliente por processo: reaproveita conexões keep-alive entre as sondagens
+    app.state.http = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=30.0),
+        timeout=httpx.Timeout(3.0),
+        http2=_http2_disponivel(),
+    )
+    sondador = asyncio.create_task(loop_sondagem())
+    yield
+    sondador.cancel()
+    await asyncio.gather(sondador, return_exceptions=True)
+    await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,34 +52,147 @@ app.add_middleware(
 )
 
 # status_api.py
-WAHA_URL = "http://waha:3000/"
-N8N_URL = "http://n8n:5678/healthz"
+WAHA_URL = os.getenv("WAHA_URL", "http://waha:3000/")
+N8N_URL = os.getenv("N8N_URL", "http://n8n:5678/healthz")
+IA_URL = os.getenv("AI_SERVICE_URL", "http://ai_service:8000").rstrip("/") + "/health"
+DATABASE_URL = os.getenv("DATABASE_URL", "")
 
+# Timeout por alvo (segundos)
+TIMEOUTS = {
+    "waha": 3.0,
+    "n8n": 3.0,
+    "ia": 3.0,
+    "postgres": 3.0,
+}
+
+# Sondagem em segundo plano: uma rodada a cada PROBE_INTERVAL_SECONDS,
+# janela de PROBE_HISTORY resultados por serviço (padrão: 1h com 15s)
+PROBE_INTERVAL = float(os.getenv("PROBE_INTERVAL_SECONDS", "15"))
+PROBE_HISTORY = int(os.getenv("PROBE_HISTORY", "240"))
+
+# nome -> deque[(timestamp, online, latency_ms)]
+historico = {}
+snapshot = {}
+primeira_rodada = asyncio.Event()
 
 
 async def medir_servico(nome: str, url: str):
     start = time.perf_counter()
     try:
-        async with httpx.AsyncClient() as client:
-            res = await client.get(url, timeout=3.0)
+        res = await app.state.http.get(url, timeout=TIMEOUTS.get(nome, 3.0))
         elapsed = round((time.perf_counter() - start) * 1000)
         return nome, {"online": res.status_code == 200, "latency_ms": elapsed}
     except Exception:
         return nome, {"online": False, "latency_ms": None}
 
-@app.get("/status-arquitetura")
-async def status_arquitetura():
-    # Executa WAHA e n8n em paralelo
-    results = await asyncio.gather(
+
+async def medir_postgres(nome: str, dsn: str):
+    # SELECT 1 via asyncpg quando instalado; senão só confirma que a porta aceita conexão
+    start = time.perf_counter()
+    try:
+        if asyncpg is not None:
+            conn = await asyncpg.connect(dsn.replace("+asyncpg", ""), timeout=TIMEOUTS[nome])
+            try:
+                await conn.fetchval("SELECT 1", timeout=TIMEOUTS[nome])
+            finally:
+                await conn.close()
+        else:
+            url = urlparse(dsn)
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(url.hostname, url.port or 5432), timeout=TIMEOUTS[nome]
+            )
+            writer.close()
+            await writer.wait_closed()
+        elapsed = round((time.perf_counter() - start) * 1000)
+        return nome, {"online": True, "latency_ms": elapsed}
+    except Exception:
+        return nome, {"online": False, "latency_ms": None}
+
+
+def _percentil(valores, p: float):
+    if not valores:
+        return None
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def resumir(nome: str) -> dict:
+    """Último resultado + uptime e p50/p95 de latência na janela do histórico."""
+    amostras = historico[nome]
+    momento, online, latencia = amostras[-1]
+    latencias = sorted(l for _, ok, l in amostras if ok and l is not None)
+    return {
+        "online": online,
+        "latency_ms": latencia,
+        "checked_at": datetime.fromtimestamp(momento, timezone.utc).isoformat(),
+        "uptime_pct": round(100 * sum(1 for _, ok, _ in amostras if ok) / len(amostras), 1),
+        "p50_ms": _percentil(latencias, 0.50),
+        "p95_ms": _percentil(latencias, 0.95),
+        "samples": len(amostras),
+    }
+
+
+async def rodada_sondagem():
+    sondas = [
         medir_servico("waha", WAHA_URL),
         medir_servico("n8n", N8N_URL),
-    )
+        medir_servico("ia", IA_URL),
+    ]
+    if DATABASE_URL:
+        sondas.append(medir_postgres("postgres", DATABASE_URL))
+
+    agora = time.time()
+    for nome, resultado in await asyncio.gather(*sondas):
+        historico.setdefault(nome, deque(maxlen=PROBE_HISTORY)).append(
+            (agora, resultado["online"], resultado["latency_ms"])
+        )
+    # Troca o dicionário inteiro: leitores nunca veem um snapshot pela metade
+    global snapshot
+    snapshot = {nome: resumir(nome) for nome in historico}
+    primeira_rodada.set()
+
+
+async def loop_sondagem():
+    proxima = time.monotonic()
+    while True:
+        try:
+            await rodada_sondagem()
+        except Exception as e:
+            logger.error(f"❌ Falha na rodada de sondagem: {e}")
+        # Intervalo fixo entre inícios de rodada, sem acumular atraso
+        proxima += PROBE_INTERVAL
+        await asyncio.sleep(max(0.0, proxima - time.monotonic()))
+
+
+@app.get("/status-arquitetura")
+async def status_arquitetura():
+    # Servido do snapshot da última rodada; só espera se a primeira ainda não terminou
+    if not primeira_rodada.is_set():
+        try:
+            await asyncio.wait_for(primeira_rodada.wait(), timeout=max(TIMEOUTS.values()) + 1)
+        except asyncio.TimeoutError:
+            pass
+    return snapshot
+
+
+@app.get("/status-historico")
+async def status_historico():
+    # Histórico bruto da janela, para gráficos de latência
+    return {
+        nome: [{"t": momento, "online": online, "latency_ms": latencia} for momento, online, latencia in amostras]
+        for nome, amostras in historico.items()
+    }
 
-    # Mede o próprio backend da IA (simplesmente interno, sem chamada HTTP)
-    start = time.perf_counter()
-    await asyncio.sleep(0.05)  # simula verificação local
-    elapsed = round((time.perf_counter() - start) * 1000)
-    results.append(("ia", {"online": True, "latency_ms": elapsed}))
 
-    # Transforma lista em dicionário final
-    return {name: data for name, data in results}
+@app.get("/pool-stats")
+async def pool_stats():
+    # Utilização do pool de conexões do cliente compartilhado (internals do httpcore)
+    pool = getattr(app.state.http._transport, "_pool", None)
+    conexoes = list(getattr(pool, "connections", []) or [])
+    ociosas = sum(1 for conn in conexoes if conn.is_idle())
+    return {
+        "connections": len(conexoes),
+        "idle": ociosas,
+        "active": len(conexoes) - ociosas,
+        "requests_waiting": sum(1 for req in getattr(pool, "_requests", []) if req.connection is None),
+        "http2": bool(getattr(pool, "_http2", False)),
+    }